@@ -0,0 +1,81 @@
+#!/usr/bin/python
+
+from pystretch.core import OptParse
+from pystretch.tests import Benchmark
+
+import argparse
+import json
+import multiprocessing
+import os
+
+
+def raster_size(value):
+    '''A raster size, N for N x N or WxH.'''
+    try:
+        if 'x' in value:
+            xsize, ysize = value.lower().split('x')
+            return int(xsize), int(ysize)
+        return int(value), int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not a raster size, e.g. 2048 or 4096x2048' %value)
+
+
+def get_parser():
+    desc = '''Time every stretch and filter of pystretcher.py on synthetic GeoTIFFs, across backends, segment sizes and numbers of workers, and write a JSON report.'''
+    parser = argparse.ArgumentParser(description=desc)
+
+    rasterOptions = parser.add_argument_group('Synthetic Rasters')
+    runOptions = parser.add_argument_group('Cases')
+    reportOptions = parser.add_argument_group('Report')
+
+    rasterOptions.add_argument('--sizes', action='store', type=raster_size, nargs='+', default=[(2048, 2048)], dest='sizes', help='The raster sizes, N or WxH.  Defaults to 2048.')
+    rasterOptions.add_argument('--dtypes', action='store', type=str, nargs='+', default=['UInt16'], choices=sorted(Benchmark._value_ranges), dest='dtypes', help='The raster types.  Defaults to UInt16.')
+    rasterOptions.add_argument('--bands', action='store', type=int, nargs='+', default=[1], dest='bands', help='The band counts.  Defaults to 1.')
+    rasterOptions.add_argument('--layouts', action='store', nargs='+', default=['tiled'], choices=['striped', 'tiled'], dest='layouts', help='Striped or tiled GeoTIFFs.  Defaults to tiled.')
+    rasterOptions.add_argument('--blocksize', action='store', type=int, default=256, dest='blocksize', help='The tile size of tiled rasters.  Defaults to 256.')
+    rasterOptions.add_argument('--nodata', action='store', type=float, nargs='+', default=[0.0], dest='nodata', help='The fractions of no data pixels.  Defaults to 0.')
+
+    runOptions.add_argument('--stretches', action='store', type=str, nargs='+', default=None, choices=sorted(OptParse.stretches), dest='stretches', help='The stretches and filters to run.  Defaults to all of them.')
+    runOptions.add_argument('--backends', action='store', nargs='+', default=['processes', 'threads'], choices=['processes', 'threads'], dest='backends', help='The backends.  Defaults to both.')
+    runOptions.add_argument('--budgets', action='store', type=str, nargs='+', default=['whole'], dest='budgets', help='The --memory-budget of each run, e.g. 64M, or whole for a single segment.  Defaults to whole.')
+    runOptions.add_argument('--cores', action='store', type=int, nargs='+', default=[1, multiprocessing.cpu_count()], dest='cores', help='The numbers of workers.  Defaults to 1 and the number of cores.')
+    runOptions.add_argument('--repeat', action='store', type=int, default=1, dest='repeat', help='Run each case this many times and keep the fastest.')
+    runOptions.add_argument('--script', action='store', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pystretcher.py'), dest='script', help='The pystretcher.py to time.  Defaults to the one beside this script.')
+    runOptions.add_argument('--directory', action='store', type=str, default=None, dest='directory', help='Generate the rasters here rather than in a temporary directory.')
+    runOptions.add_argument('--keep', action='store_true', default=False, dest='keep', help='Keep the rasters.')
+
+    reportOptions.add_argument('--output', '-o', action='store', type=str, default='pystretch_bench.json', dest='output', help='The JSON report.  Defaults to pystretch_bench.json')
+    reportOptions.add_argument('--compare', action='store', type=str, default=None, dest='compare', metavar='REPORT', help='An earlier report, e.g. of the last release, to print the speedup of each case against.')
+    return parser
+
+
+def main(args):
+    rasters = []
+    for (xsize, ysize) in args.sizes:
+        for dtype in args.dtypes:
+            for bands in args.bands:
+                for layout in args.layouts:
+                    for nodata in args.nodata:
+                        rasters.append({'xsize' : xsize,
+                                        'ysize' : ysize,
+                                        'bands' : bands,
+                                        'dtype' : dtype,
+                                        'tiled' : layout == 'tiled',
+                                        'blocksize' : args.blocksize,
+                                        'nodata' : nodata})
+    budgets = [None if budget == 'whole' else budget for budget in args.budgets]
+
+    report = Benchmark.run(args.script, rasters, args.stretches, args.backends, budgets, args.cores, args.repeat, args.directory, args.keep)
+    Benchmark.write_report(report, args.output)
+    print "Report written to %s" %args.output
+
+    if args.compare != None:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print "%-80s %10s %10s %8s" %('Case', 'Mpx/s was', 'Mpx/s now', 'Speedup')
+        for name, before, after, speedup in Benchmark.compare(old, report):
+            print "%-80s %10.2f %10.2f %7.2fx" %(name, before, after, speedup)
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
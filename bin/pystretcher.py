@@ -1,8 +1,9 @@
 #!/usr/bin/python
 
 #Internal imports
-from pystretch.core import GdalIO, ArrayConvert, OptParse, Stats, Timer
+from pystretch.core import Batch, Cache, GdalIO, Lookup, NoData, OptParse, Pipeline, Stats, Steps, Timer, WorkerPool
 from pystretch.masks import Segment
+from pystretch.filter import Filter
 
 #Debugging imports
 #import profile
@@ -10,8 +11,10 @@ from pystretch.masks import Segment
 
 import multiprocessing
 from contextlib import closing
+import copy
 import sys
 import time
+import traceback
 import gc
 
 #External imports
@@ -39,167 +42,371 @@ try:
 except ImportError:
     print "Some functionality will not work without scipy installed."
 
+
+def plan(args, raster, steps):
+    '''
+    Segment a raster to handle either RAM constraints or selective processing.
+    Every band of a segment is in memory at once.
+
+    Returns the halo of the steps, the overview factors, the segments, the 
+    windows read for each segment and the working type of the buffers.
+    '''
+    xsize = raster.RasterXSize
+    ysize = raster.RasterYSize
+    bands = raster.RasterCount
+
+    #The narrowest type each segment can be stretched in
+    working = Steps.working_type(steps, [Stats.band_datatype(raster.GetRasterBand(b+1)) for b in xrange(bands)])
+
+    #Neighbourhood filters read every segment with a halo of the surrounding pixels, 
+    #chained filters each need their own halo
+    halo = sum([Filter.halo(stretch, stepargs) for stretch, stepargs in steps])
+
+    #Overviews are written from each segment, so segments cover whole overview pixels
+    factors = []
+    if args.memmap == False and (args.overviews != None or args.cog == True):
+        factors = args.overviews or GdalIO.overview_factors(xsize, ysize, args.blocksize)
+
+    if args.memory_budget != None:
+        inband = raster.GetRasterBand(1)
+        itemsize = gdal.GetDataTypeSize(inband.DataType) // 8
+        footprint = Segment.pixel_footprint(itemsize, buffers=3, scratch=halo > 0, working=working.itemsize) * bands
+        segments = Segment.plan_segments(xsize, ysize, inband.GetBlockSize(), args.memory_budget, footprint, halo)
+    else:
+        segments = Segment.segment_image(xsize,ysize,args.vint, args.hint)
+    if factors:
+        segments = Segment.align_segments(segments, xsize, ysize, max(factors))
+    windows = [Segment.add_halo(chunk, halo, xsize, ysize) for chunk in segments]
+    if args.memory_budget != None:
+        largest = max([w[2] * w[3] for w in windows]) * footprint
+        if largest > args.memory_budget:
+            print "The smallest windows read, %d bytes, exceed the memory budget." % largest
+    return halo, factors, segments, windows, working
+
+
+def fits(pool, size, bands, halo, working):
+    '''
+    Can a pool stretch windows of size pixels of every band in the working
+    type, or a wider one, with the scratch arrays of any filters.
+    '''
+    if pool.size < size or len(pool.buffers) < bands:
+        return False
+    if not numpy.can_cast(working, pool.buffers[0].dtype):
+        return False
+    return halo == 0 or pool.buffers[0].scratch is not None
+
     
-def main(args):
+def main(args, pool=None):
 
     starttime = Timer.starttimer()
-    #Cache thrashing is common when working with large files, we help alleviate misses by setting a larger than normal cache.  1GB
-    #gdal.SetCacheMax(1073741824)
-    gdal.SetCacheMax(2147483648)
+    Timer.reset()
+    if args.trace != None:
+        Timer.start_trace()
+    #Cache thrashing is common when working with large files, we help alleviate misses by setting a larger than normal cache.  2GB by default
+    gdal.SetCacheMax(args.gdal_cache)
     
     #Check for input
     if not args:
         print "\nERROR: You must supply an input data set.\n"
         sys.exit(0)
     
-    #Get stretch type
-    stretch = OptParse.get_stretch(args)
-    
-    #Get some info about the machine for multiprocessing
-    cores = multiprocessing.cpu_count()
-    cores *= 2
-    print "Processing on %i cores." %cores
+    #Get the stretch type, or the chain of stretches to apply in a single pass
+    args.normalized = False
+    steps = Steps.get_steps(args)
     
     #Load the input dataset using the GdalIO class and get / set the output datatype.
     dataset = GdalIO.GdalIO(args.input_data)
     raster = dataset.load()
 
+    #A preview stretches a reduced copy, read from the overviews, with the same settings
+    if args.preview != None:
+        raster = GdalIO.preview(raster, args.preview)
+
     #Default is none, unless user specified
     if args.dtype == None:
         dtype = gdal.GetDataTypeName(raster.GetRasterBand(1).DataType)
     else:
         dtype=args.dtype
     
-    #Create an output if the stretch is written to disk
+    #Segment the image, with the halo of any filters, before the output is created
     xsize, ysize, bands, projection, geotransform = dataset.info(raster)
-    output = dataset.create_output("",args.output,xsize,ysize,bands,projection, geotransform, gdal.GetDataTypeByName(dtype))
+    halo, factors, segments, windows, working = plan(args, raster, steps)
+
+    #Create an output if the stretch is written to disk
+    #A raw output is written by the workers through memory maps
+    if args.memmap == True:
+        output = GdalIO.MemmapOutput(args.output, xsize, ysize, bands, projection, geotransform, gdal.GetDataTypeByName(dtype))
+    else:
+        #A COG is written as a tiled GeoTIFF with overviews and copied into the COG layout at the end
+        outputname = args.output
+        outputformat = args.outputFormat
+        options = args.creation_options or []
+        if args.cog == True:
+            outputname = args.output + '.tmp.tif'
+            outputformat = 'GTiff'
+        if outputformat == 'GTiff':
+            options = GdalIO.creation_options(args.tiled or args.cog, args.blocksize, args.compress, args.predictor, args.bigtiff, options)
+        output = dataset.create_output(outputformat, outputname, xsize, ysize, bands, projection, geotransform, gdal.GetDataTypeByName(dtype), options)
 
-    #Segment the image to handle either RAM constraints or selective processing
-    segments = Segment.segment_image(xsize,ysize,args.vint, args.hint)
+        #Overviews are written from each stretched segment
+        if factors:
+            GdalIO.create_overviews(output, factors, args.compress, args.predictor)
 
+    #Start the workers once, with three shared buffers per band large enough for the biggest
+    #segment so that one segment can be read and another written while a third is stretched.
+    #Segments are read straight into the buffers, of the working type, there are no other copies.
+    #A pool which is passed in, e.g. by a batch, is used if it is large enough.
+    size = max([window[2] * window[3] for window in windows])
+    owned = pool is None or not fits(pool, size, bands, halo, working)
+    if owned:
+        pool = WorkerPool.backends[args.backend](size, processes=args.processes, buffers=3 * bands, dtype=working, scratch=halo > 0, profile=args.profile_worker)
+    pipeline = Pipeline.Pipeline(pool, depth=2)
+    print "Processing on %i %s in %s." %(pool.processes, args.backend, pool.buffers[0].dtype)
+
+    #Pixel interleaved data is read once for all bands, otherwise band by band
+    interleaved = bands > 1 and raster.GetMetadataItem('INTERLEAVE', 'IMAGE_STRUCTURE') == 'PIXEL'
+
+    #Band statistics are kept between runs if there is a cache.  A preview caches its
+    #statistics for the input, so the full resolution run stretches as the preview did
+    cache = None
+    if args.stats_cache != None:
+        cache = Cache.StatsCache(args.stats_cache)
+
+    def approximate_stats(b, band, stepargs):
+        #Estimate the band statistics from a sample of blocks or the coarsest overview,
+        #or None if the estimate is not within the tolerance
+        source = band
+        fraction = args.approx_stats
+        if args.approx_source == 'overview' and band.GetOverviewCount() > 0:
+            source = band.GetOverview(band.GetOverviewCount() - 1)
+            fraction = 1.0
+        windows = Segment.sample_blocks(source.XSize, source.YSize, source.GetBlockSize(), fraction, pool.size)
+        stats = Stats.get_approx_band_stats(source, windows, pipeline, stepargs)
+        print "Band %i statistics estimated from %i pixels in %i windows:" %(b + 1, stats['sample_count'], len(windows))
+        print "    mean %g +/- %g" %(stats['bandmean'], stats['bandmean_error'])
+        print "    std %g +/- %g" %(stats['bandstd'], stats['bandstd_error'])
+        error = max(stats['bandmean_error'], stats['bandstd_error'])
+        for key in ('lowerbound', 'upperbound'):
+            if key in stats:
+                print "    %s %g +/- %g" %(key, stats[key], stats[key + '_error'])
+                error = max(error, stats[key + '_error'])
+        if numpy.isinf(error):
+            #A single window gives no estimate of the error at all
+            print "    The error can not be estimated, calculating exact statistics."
+            return None
+        if args.approx_tolerance != None and error > args.approx_tolerance * (stats['bandmax'] - stats['bandmin']):
+            print "    The error exceeds the tolerance, calculating exact statistics."
+            return None
+        return stats
+
+    #Statistics, and lookup tables, for every band before any band is stretched
+    Timer.add('setup', time.time() - starttime)
+    bandsteps = []
+    luts = []
+    ndvs = []
+    outndvs = []
+    native = []
+    #Filters are given the no data as NaN, which they spread, so it does not read as data
+    fill = halo > 0 and args.ndv != None
     for b in xrange(bands):
         band = raster.GetRasterBand(b+1)
-        bandstats = Stats.get_band_stats(band, args)
-        
-        for key in bandstats.iterkeys():
-            #print (key, bandstats[key])
-            if key == 'bandmax':
-                args.bandmax = bandstats['bandmax']
-            elif key == 'bandstd':
-                args.bandstd = bandstats['bandstd']
-            elif key == 'bandmin':
-                args.bandmin = bandstats['bandmin']
-            elif key == 'ndv_band':
-                args.ndv_band = bandstats['ndv_band']
-            elif key == 'bandmean':
-                args.bandmean = bandstats['bandmean']
-#            elif key == 'lowerbound':
-#                args.lowerbound = bandstats['lowerbound']
-#            elif key == 'upperbound':
-#                args.upperbound = bandstats['upperbound']
-#        args.reduction = 0.1
-        #Get the size of the segments to be manipulated
-        piecenumber = 1
-        for chunk in segments:
-            
-            print "Image segmented.  Processing segment %i of %i" %(piecenumber, len(segments))
-            piecenumber += 1
-            (xstart, ystart, intervalx, intervaly) = chunk
-            
-            array = band.ReadAsArray(xstart, ystart, intervalx, intervaly).astype(numpy.float32)
+        ndv_band = band.GetNoDataValue()
+        ndv = ndv_band if ndv_band != None else args.ndv
+        outndv = args.ndv if args.ndv != None else ndv_band
+        steps_b = Steps.copy_steps(steps)
 
-            if args.ndv_band != None:
-                array = numpy.ma.masked_values(array, args.ndv_band, copy=False)
-            elif args.ndv != None:
-                array = numpy.ma.masked_values(array, args.ndv, copy=False)
-            
-            if 'stretch' in stretch.__name__:
-                array = Stats.normalize(array, args.bandmin, args.bandmax, dtype)
-                args.normalized = True
-
-                #print(args)
-            if args.clip > 0:  
-                stats = Stats.get_array_percentile(array, args.clip) 
-                args.lowerbound = stats['lowerbound']
-                args.upperbound = stats['upperbound']
-                
-            #If the user wants to calc stats per segment:
-            if args.segment == True:  
-                stats = Stats.get_array_stats(array, stretch) 
-                for key in stats.iterkeys():
-                    args[key] = stats[key]
-            #Otherwise use the stats per band for each segment
+        def read(chunk, slot):
+            return GdalIO.read_into(band, Segment.add_halo(chunk, halo, xsize, ysize), pool.buffers[slot])
+
+        def read_window(chunk):
+            return Segment.add_halo(chunk, halo, xsize, ysize)
+
+        def step_ready(count):
+            #Apply the first count steps to a segment read into its buffer, returns whether it has no data
+            def ready(chunk, slot):
+                nodata = Steps.mask_nodata(pool, slot, ndv, fill)
+                for stretch, stepargs in steps_b[:count]:
+                    stepargs.origin = read_window(chunk)[:2]
+                    Steps.apply(pool, slot, nodata, stretch, stepargs, dtype)
+                return nodata
+            return ready
+
+        def step_input(count):
+            #The output of the first count steps, without the halo, to calculate statistics from
+            def prepare(chunk, array, slot):
+                nodata = step_ready(count)(chunk, slot)
+                data = Segment.crop_halo(pool.buffers[slot].asarray(), chunk, halo, xsize, ysize)
+                if not nodata:
+                    return data, None
+                return data, Segment.crop_halo(NoData.valid(pool.buffers[slot], slice(None)), chunk, halo, xsize, ysize)
+            return prepare
+
+        with Timer.stage('stats', band=b + 1):
+            bandstats = {}
+            for count, (stretch, stepargs) in enumerate(steps_b):
+                if count == 0:
+                    total = None
+                    approx = None
+                    if cache is not None and stepargs.segment == False:
+                        total = cache.get(args.input_data, b + 1, ndv)
+                    if total is None and args.approx_stats != None and stepargs.segment == False:
+                        approx = approximate_stats(b, band, stepargs)
+
+                    if total is not None:
+                        #A cached band is never scanned again
+                        bandstats = Stats.running_band_stats(total, ndv_band, stepargs.clip)
+                    elif approx is not None:
+                        bandstats = approx
+                    elif cache is not None and stepargs.segment == False:
+                        #Scan the band once and cache it
+                        total = Stats.stream_band(band, segments, pipeline, stepargs)
+                        cache.put(args.input_data, b + 1, ndv, total)
+                        if args.preview != None:
+                            print "Band %i statistics of the preview cached for the full resolution." %(b + 1)
+                        bandstats = Stats.running_band_stats(total, ndv_band, stepargs.clip)
+                    #Clipping needs band wide percentiles, so make a streaming pass over every segment
+                    elif stepargs.clip > 0 and stepargs.segment == False:
+                        bandstats = Stats.get_streaming_band_stats(band, segments, pipeline, stepargs)
+                    else:
+                        bandstats = Stats.get_band_stats(band, stepargs)
+                elif Steps.needs_stats(stretch) and stepargs.segment == False:
+                    #Later stretches see the output of the steps before them
+                    print "Calculating statistics for band %i, step %i of %i" %(b + 1, count + 1, len(steps_b))
+                    bandstats = Stats.get_streaming_stats(pipeline, segments, read, step_input(count), stepargs.clip)
+                    bandstats['ndv_band'] = ndv_band
+                Steps.set_band_stats(stepargs, bandstats, stretch, dtype)
+                if stepargs.clahe_stretch == True:
+                    #The tile histograms are over the whole band, whatever the segments
+                    print "Calculating tile histograms for band %i, step %i of %i" %(b + 1, count + 1, len(steps_b))
+                    stepargs.tile_grid = Stats.tile_grid(xsize, ysize, stepargs.tiles)
+                    stepargs.tile_cdfs = Stats.get_tile_cdfs(pipeline, segments, read, step_ready(count), read_window, stepargs)
+
+        #Point stretches of 8 and 16-bit data are evaluated once per possible value
+        datatype = Stats.band_datatype(band)
+        stretch, stepargs = steps_b[0]
+        lut = None
+        if len(steps_b) == 1 and Lookup.supported(stretch, datatype, stepargs):
+            stepargs.mean = stepargs.bandmean
+            stepargs.maximum = stepargs.bandmax
+            stepargs.minimum = stepargs.bandmin
+            stepargs.standard_deviation = stepargs.bandstd
+            with Timer.stage('lut', band=b + 1):
+                lut = Lookup.build_lut(stretch, datatype, dtype, stepargs)
+
+        bandsteps.append(steps_b)
+        luts.append(lut)
+        ndvs.append(ndv)
+        outndvs.append(outndv)
+        native.append(lut is not None and Stats.datatype(datatype) == pool.buffers[0].dtype)
+
+    def read(chunk, slot):
+        #Bands to be stretched are read into their shared buffers, native arrays are returned
+        #for the LUTs and None for the other bands.  Buffers of the native type hold the native arrays.
+        window = Segment.add_halo(chunk, halo, xsize, ysize)
+        (xstart, ystart, intervalx, intervaly) = window
+        arrays = [None] * bands
+        if interleaved:
+            interleave = raster.ReadAsArray(xstart, ystart, intervalx, intervaly)
+            for b in xrange(bands):
+                if luts[b] is None:
+                    with Timer.stage('copy', band=b + 1):
+                        pool.buffers[slot * bands + b].load(interleave[b])
+                else:
+                    arrays[b] = interleave[b]
+        else:
+            for b in xrange(bands):
+                band = raster.GetRasterBand(b+1)
+                if luts[b] is None:
+                    GdalIO.read_into(band, window, pool.buffers[slot * bands + b])
+                elif native[b]:
+                    arrays[b] = GdalIO.read_into(band, window, pool.buffers[slot * bands + b])
+                else:
+                    arrays[b] = band.ReadAsArray(xstart, ystart, intervalx, intervaly)
+        return arrays
+
+    def compute(chunk, arrays, slot):
+        print "Image segmented.  Processing segment %i of %i" %(segments.index(chunk) + 1, len(segments))
+        results = [None] * bands
+        stretched = []
+        for b in xrange(bands):
+            if luts[b] is not None:
+                with Timer.stage('lut', band=b + 1):
+                    results[b] = Lookup.apply_lut(luts[b], arrays[b])
             else:
-                args.mean = args.bandmean
-                args.maximum = args.bandmax
-                args.minimum = args.bandmin
-                args.standard_deviation = args.bandstd
-            
-            y,x = array.shape
-            
-            #Calculate the hist and cdf if we need it.  This way we do not calc it per core.
-            if args.histequ_stretch == True:
-                cdf, bins = Stats.gethist_cdf(array,args.num_bins)
-                args.cdf = cdf
-                args.bins = bins
-            
+                stretched.append(b)
 
-            #Fill the masked values with NaN to get to a shared array
-            if args.ndv != None:
-                array = array.filled(numpy.nan)
-            
-            #Create an ctypes array
-            init(ArrayConvert.SharedMemArray(array))
-            options = args
-            step = y // cores
-            jobs = []
-            if step != 0:
-                for i in range(0,y,step):        
-                    p = multiprocessing.Process(target=stretch,args= (shared_arr,slice(i, i+step),args))
-                    jobs.append(p)
-                    
-                for job in jobs:
-                    job.start()
-                    del job
-                for job in jobs:
-                    job.join()
-                    del job
-            
-            #Return the array to the proper data range and write it out.  Scale if that is what the user wants
-            #if args.histequ_stretch or args.gamma_stretch== True:
-            #    pass
-            #elif 'filter' in stretch.__name__:
-            #    pass
-            #else:
-            if args.normalized == True:
-                Stats.denorm(shared_arr.asarray(), dtype, args)
-
-            if args.scale != None:
-                Stats.scale(shared_arr.asarray(), args)
-                
-            #If their are NaN in the array replace them with the dataset no data value
-            Stats.setnodata(shared_arr, args.ndv)
-
-            #Write the output
-            output.GetRasterBand(b+1).WriteArray(shared_arr.asarray(), xstart,ystart)            
-            #Manually cleanup to stop memory leaks.
-            del array, jobs, shared_arr.data
-            try: 
-                del stats
-            except:
-                pass
-            del globals()['shared_arr']
-            gc.collect()
+        #The workers mark the no data of every band in its packed mask
+        tags = [{'band' : b + 1} for b in stretched]
+        with Timer.stage('mask'):
+            masked = Steps.mask_many(pool, [(slot * bands + b, ndvs[b], fill) for b in stretched], tags)
+        nodata = dict(zip(stretched, masked))
+
+        #Every band of the segment is stretched together, one step at a time
+        #The workers scale the last step and write the no data value as they go
+        #Steps which depend on the place of a pixel in the band, e.g. clahe_stretch, see where the segment is
+        origin = Segment.add_halo(chunk, halo, xsize, ysize)[:2]
+        for b in stretched:
+            for stretch, stepargs in bandsteps[b]:
+                stepargs.origin = origin
+        for count in xrange(len(steps)):
+            items = [(slot * bands + b, nodata[b]) + bandsteps[b][count] for b in stretched]
+            Steps.apply_many(pool, items, dtype, tags, last=count == len(steps) - 1, ndvs=[outndvs[b] for b in stretched])
+
+        tickets = []
+        for b in stretched:
+            shared_arr = pool.buffers[slot * bands + b]
+            if args.memmap == True:
+                #The workers write their rows straight into the output
+                window = Segment.add_halo(chunk, halo, xsize, ysize)
+                tickets.append(pool.submit(GdalIO.write_memmap, slot * bands + b, output.settings(b, chunk, window), tags={'band' : b + 1}))
+            else:
+                results[b] = Segment.crop_halo(shared_arr.asarray(), chunk, halo, xsize, ysize)
+        for ticket in tickets:
+            pool.wait(ticket)
+        return results
+
+    def write(chunk, arrays):
+        (xstart, ystart, intervalx, intervaly) = chunk
+        for b in xrange(bands):
+            if args.memmap == False:
+                output.GetRasterBand(b+1).WriteArray(arrays[b], xstart,ystart)
+                if factors:
+                    with Timer.stage('overviews', band=b + 1):
+                        GdalIO.write_overviews(output.GetRasterBand(b+1), arrays[b], chunk, factors, args.overview_resampling, outndvs[b])
+            elif arrays[b] is not None:
+                output.write(b, chunk, arrays[b])
+
+    #Read the next segment and write the previous one while this one is stretched
+    #Every stage is timed, and traced, with the segment
+    number = lambda chunk, *rest: {'segment' : segments.index(chunk) + 1}
+    Pipeline.Pipeline(pool, depth=2, width=bands).run(segments, Timer.timed('read', read, number), Timer.timed('compute', compute, number), Timer.timed('write', write, number))
+    mark = time.time()
+    gc.collect()
+    if args.memmap == True:
+        output = output.close()
             
-            if args.ndv != None:
-                output.GetRasterBand(b+1).SetNoDataValue(float(args.ndv))
-            elif args.ndv_band != None:
-                output.GetRasterBand(b+1).SetNoDataValue(float(args.ndv_band))
-                
+    for b in xrange(bands):
+        if args.ndv != None:
+            output.GetRasterBand(b+1).SetNoDataValue(float(args.ndv))
+        elif raster.GetRasterBand(b+1).GetNoDataValue() != None:
+            output.GetRasterBand(b+1).SetNoDataValue(float(raster.GetRasterBand(b+1).GetNoDataValue()))
+
+    if args.cog == True:
+        #The copy is closed, so written, as soon as it is returned
+        GdalIO.translate_cog(output, args.output, args.compress, args.predictor, args.bigtiff, args.blocksize, args.creation_options)
+        output = None
+        gdal.GetDriverByName('GTiff').Delete(outputname)
                 
     if args.visualize == True:
-        Plot.show_hist(shared_arr.asarray())
+        Plot.show_hist(pool.buffers[0].asarray())
     
+    if owned:
+        pool.close()
+    Timer.add('finish', time.time() - mark)
+    if args.timings != None:
+        Timer.write_stages(args.timings, starttime, xsize * ysize * bands)
+    if args.trace != None:
+        Timer.write_trace(args.trace)
     Timer.totaltime(starttime)
     
     #Close up
@@ -207,9 +414,105 @@ def main(args):
     output = None
     gc.collect()
 
-def init(shared_arr_):
-    global shared_arr
-    shared_arr = shared_arr_ # must be inhereted, not passed as an argument global array
+def run_file(shared_array, i, args):
+    #Worker function of a batch, a whole small input is stretched in a single worker
+    start = time.time()
+    try:
+        main(args)
+    except SystemExit as exit:
+        #The worker would stop and the batch wait on it forever, so fail the input instead
+        raise RuntimeError("%s exited with status %s" %(args.input_data, exit.code))
+    return time.time() - start
+
+
+def batch(args):
+    '''
+    Stretch every input of a batch, see pystretch.core.Batch, with one pool.
+
+    Small inputs are stretched whole, one per worker, so that many are in 
+    flight at once.  Larger inputs are stretched one at a time in this process
+    with their segments split across the same workers.  With the threads 
+    backend every input is stretched as a larger one, since main keeps its 
+    timings, trace and memory maps in module state which concurrent threads
+    would share.
+    '''
+    starttime = Timer.starttimer()
+    report = Batch.Report(args.report)
+    small = []
+    large = []
+    skipped = 0
+    stretched = 0
+    failed = 0
+    size = 1
+    bands = 1
+    halo = 0
+    working = numpy.dtype(numpy.uint8)
+    outputs = [output for path, output in report.done]
+    for path, settings in Batch.expand_inputs(args.input_data, args.output_template, outputs):
+        fileargs = copy.deepcopy(args)
+        fileargs.batch = False
+        fileargs.input_data = path
+        fileargs.output = Batch.output_name(args.output_template, path)
+        for key, value in settings.iteritems():
+            setattr(fileargs, key, value)
+        if report.completed(path, fileargs.output):
+            skipped += 1
+            continue
+
+        #Size the pool for the largest segment of the larger inputs
+        try:
+            raster = gdal.Open(path, gdal.GA_ReadOnly)
+            if raster is None:
+                raise IOError("%s could not be opened." %path)
+            if args.backend == 'processes' and raster.RasterXSize * raster.RasterYSize * raster.RasterCount <= args.batch_small:
+                small.append(fileargs)
+            else:
+                fileargs.normalized = False
+                filehalo, factors, segments, windows, filetype = plan(fileargs, raster, Steps.get_steps(fileargs))
+                size = max([size] + [window[2] * window[3] for window in windows])
+                bands = max(bands, raster.RasterCount)
+                halo = max(halo, filehalo)
+                working = numpy.promote_types(working, filetype)
+                large.append(fileargs)
+            raster = None
+        except Exception:
+            failed += 1
+            report.record(path, fileargs.output, False, 0, traceback.format_exc())
+
+    print "%i inputs to stretch, %i small and %i large, %i already stretched." %(len(small) + len(large), len(small), len(large), skipped)
+    pool = WorkerPool.backends[args.backend](size, processes=args.processes, buffers=3 * bands, dtype=working, scratch=halo > 0)
+
+    #Small inputs are queued first, each stretched by a single thread in a worker process
+    tickets = []
+    for fileargs in small:
+        fileargs.backend = 'threads'
+        fileargs.processes = 1
+        tickets.append((fileargs, pool.submit(run_file, 0, fileargs, slices=[slice(0, 0)])))
+
+    for fileargs in large:
+        start = time.time()
+        try:
+            main(fileargs, pool)
+            stretched += 1
+            report.record(fileargs.input_data, fileargs.output, True, time.time() - start)
+        except (Exception, SystemExit):
+            failed += 1
+            report.record(fileargs.input_data, fileargs.output, False, time.time() - start, traceback.format_exc())
+
+    for fileargs, ticket in tickets:
+        try:
+            seconds = pool.wait(ticket)[0]
+            stretched += 1
+            report.record(fileargs.input_data, fileargs.output, True, seconds)
+        except RuntimeError as error:
+            failed += 1
+            report.record(fileargs.input_data, fileargs.output, False, 0, str(error))
+
+    pool.close()
+    report.close()
+    print "%i stretched, %i failed.  See %s" %(stretched, failed, args.report)
+    Timer.totaltime(starttime)
+
 
 if __name__ == '__main__':
     multiprocessing.freeze_support()
@@ -217,5 +520,8 @@ if __name__ == '__main__':
     args = OptParse.parse_arguments()
     gdal.SetConfigOption('CPL_DEBUG', 'ON')
 
-    main(args)
+    if args.batch == True:
+        batch(args)
+    else:
+        main(args)
     
@@ -0,0 +1 @@
+from pystretch.core.Stretcher import Stretcher, stretch
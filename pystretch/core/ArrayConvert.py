@@ -19,8 +19,17 @@ _ctypes_to_numpy = {
 }
 
 
-_numpy_to_ctypes = dict((value, key) for key, value in
-                                _ctypes_to_numpy.iteritems())
+#Explicit, the inverse of _ctypes_to_numpy is many to one and c_wchar and c_long are wider than their numpy types
+_numpy_to_ctypes = {
+    numpy.int8 : ctypes.c_byte,
+    numpy.uint8 : ctypes.c_ubyte,
+    numpy.int16 : ctypes.c_short,
+    numpy.uint16 : ctypes.c_ushort,
+    numpy.int32 : ctypes.c_int32,
+    numpy.uint32 : ctypes.c_uint32,
+    numpy.float32 : ctypes.c_float,
+    numpy.float64 : ctypes.c_double
+}
 
 class SharedMemArray(object):
     """ Wrapper around multiprocessing.Array to share an array accross
@@ -47,8 +56,135 @@ class SharedMemArray(object):
  
     def asarray(self):
         return self.__array__()
-    
-    
+
+
+class SharedMemBuffer(SharedMemArray):
+    """ A preallocated block of shared memory which is reused for every
+        segment.  The buffer is created once, before any worker processes
+        are started, so that the workers inherit it and never need to have
+        the data passed to them.
+
+        The shape of the array view changes with each segment loaded, the
+        size (number of elements) can never exceed the size allocated.
+
+        Neighbourhood filters can not write in place, they read from the 
+        array and write to a second, scratch, array of the same shape.
+
+        The no data mask of the segment, a bit per element, is kept beside
+        it, see NoData.
+    """
+
+    def __init__(self, size, dtype=numpy.float32, scratch=False):
+        """ Allocate, but do not initialize, size elements of type dtype, 
+            their no data mask and optionally a scratch array of the same 
+            size.
+        """
+        self.dtype = numpy.dtype(dtype)
+        self.data = RawArray(_numpy_to_ctypes[self.dtype.type], size)
+        self.mask = RawArray(ctypes.c_ubyte, (size + 7) // 8)
+        self.scratch = None
+        if scratch:
+            self.scratch = RawArray(_numpy_to_ctypes[self.dtype.type], size)
+        self.size = size
+        self.shape = (size, )
+
+    def __array__(self):
+        """ Implement the array protocole, only the elements covered by the
+            current shape are returned.
+        """
+        count = int(numpy.prod(self.shape))
+        array = shmem_as_ndarray(self.data, dtype=self.dtype)[:count]
+        array.shape = self.shape
+        return array
+
+    def scratch_asarray(self):
+        """ The scratch array, with the current shape.
+        """
+        if self.scratch is None:
+            raise ValueError("The shared buffer was allocated without a scratch array.")
+        count = int(numpy.prod(self.shape))
+        array = shmem_as_ndarray(self.scratch, dtype=self.dtype)[:count]
+        array.shape = self.shape
+        return array
+
+    def mask_asarray(self):
+        """ The packed no data mask of the elements of the current shape, 
+            as a flat uint8 array, see NoData.
+        """
+        count = int(numpy.prod(self.shape))
+        return shmem_as_ndarray(self.mask, dtype=numpy.uint8)[:(count + 7) // 8]
+
+    def reshape(self, shape):
+        """ Set the shape of the view onto the buffer without touching the data.
+        """
+        if int(numpy.prod(shape)) > self.size:
+            raise ValueError("A %s array does not fit in a shared buffer of %i elements." %(str(shape), self.size))
+        self.shape = tuple(shape)
+
+    def load(self, array):
+        """ Copy an array into the buffer and take on its shape.
+        """
+        self.reshape(array.shape)
+        self.asarray()[...] = array
+
+
+class ArrayBuffer(object):
+    """ The buffer of the thread backend, with the interface of 
+        SharedMemBuffer.  Threads share memory, so the buffer is a plain 
+        ndarray which GDAL reads into and the workers stretch in place.
+    """
+
+    def __init__(self, size, dtype=numpy.float32, scratch=False):
+        """ Allocate size elements of type dtype, their no data mask and 
+            optionally a scratch array.
+        """
+        self.dtype = numpy.dtype(dtype)
+        self.data = numpy.empty(size, dtype=self.dtype)
+        self.mask = numpy.zeros((size + 7) // 8, dtype=numpy.uint8)
+        self.scratch = None
+        if scratch:
+            self.scratch = numpy.empty(size, dtype=self.dtype)
+        self.size = size
+        self.shape = (size, )
+
+    def __array__(self):
+        """ A view onto the buffer with the current shape.
+        """
+        count = int(numpy.prod(self.shape))
+        return self.data[:count].reshape(self.shape)
+
+    def asarray(self):
+        return self.__array__()
+
+    def scratch_asarray(self):
+        """ The scratch array, with the current shape.
+        """
+        if self.scratch is None:
+            raise ValueError("The buffer was allocated without a scratch array.")
+        count = int(numpy.prod(self.shape))
+        return self.scratch[:count].reshape(self.shape)
+
+    def mask_asarray(self):
+        """ The packed no data mask of the elements of the current shape, 
+            as a flat uint8 array, see NoData.
+        """
+        count = int(numpy.prod(self.shape))
+        return self.mask[:(count + 7) // 8]
+
+    def reshape(self, shape):
+        """ Set the shape of the view onto the buffer without touching the data.
+        """
+        if int(numpy.prod(shape)) > self.size:
+            raise ValueError("A %s array does not fit in a buffer of %i elements." %(str(shape), self.size))
+        self.shape = tuple(shape)
+
+    def load(self, array):
+        """ Copy an array into the buffer and take on its shape.
+        """
+        self.reshape(array.shape)
+        self.asarray()[...] = array
+
+
 def shmem_as_ndarray(data, dtype=float):
     """ Given a multiprocessing.Array object, as created by
     ndarray_to_shmem, returns an ndarray view on the data.
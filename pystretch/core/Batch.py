@@ -0,0 +1,104 @@
+"""
+Batch runs one stretch over many inputs with a single worker pool.
+
+The inputs are given as one of:
+    - a glob, quoted so the shell does not expand it, e.g. 'scenes/*.tif'
+    - a file list, @scenes.txt, with one path per line
+    - a JSON manifest, a list of objects with the input, an optional output
+      and any settings for that input by their dest name, e.g.
+      [{"input": "a.tif", "clip": 2}, {"input": "b.tif", "output": "b8.tif"}]
+
+Outputs are named by a template, see output_name.  Every input is recorded in
+a CSV report as it completes, so a batch which is stopped is resumed by
+running it again: inputs with a successful report line whose output exists
+are skipped.
+"""
+import csv
+import glob
+import json
+import os
+
+
+def expand_inputs(spec, template=None, outputs=()):
+    '''
+    Returns the inputs of a batch as a list of (input, settings) pairs,
+    settings being a dictionary which is empty unless given by a manifest.
+
+    A glob also matches the outputs of earlier runs, e.g. scenes/*.tif and
+    scenes/a_stretched.tif, so paths which are the output of another match 
+    by the template, see output_name, or one of outputs, e.g. those in the
+    report, are left out.  Lists and manifests are used as given.
+    '''
+    if spec.startswith('@'):
+        with open(spec[1:]) as f:
+            lines = [line.strip() for line in f]
+        return [(line, {}) for line in lines if line and not line.startswith('#')]
+
+    if spec.lower().endswith('.json') and os.path.isfile(spec):
+        with open(spec) as f:
+            entries = json.load(f)
+        inputs = []
+        for entry in entries:
+            entry = dict((str(key), value) for key, value in entry.iteritems())
+            inputs.append((str(entry.pop('input')), entry))
+        return inputs
+
+    paths = sorted(glob.glob(spec))
+    excluded = set(os.path.normpath(output) for output in outputs)
+    if template is not None:
+        for path in paths:
+            output = os.path.normpath(output_name(template, path))
+            if output != os.path.normpath(path):
+                excluded.add(output)
+    return [(path, {}) for path in paths if os.path.normpath(path) not in excluded]
+
+
+def output_name(template, path):
+    '''
+    The output of an input named by a template.  {dir}, {name} and {ext} are
+    the directory, name without extension and extension of the input, e.g.
+    {dir}/{name}_stretched.tif.
+    '''
+    directory, filename = os.path.split(path)
+    name, ext = os.path.splitext(filename)
+    return template.format(dir=directory or '.', name=name, ext=ext)
+
+
+class Report(object):
+    '''
+    A CSV report of a batch with a line per input: the input, the output, ok or
+    failed, the time taken in seconds and the error.  Lines are flushed as they
+    are written so the report survives a crash.
+    '''
+
+    fields = ['input', 'output', 'status', 'seconds', 'message']
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.done = set()
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for row in csv.DictReader(f):
+                    if row['status'] == 'ok':
+                        self.done.add((row['input'], row['output']))
+        exists = os.path.exists(filename) and os.path.getsize(filename) > 0
+        self._file = open(filename, 'ab')
+        self._writer = csv.writer(self._file)
+        if not exists:
+            self._writer.writerow(self.fields)
+            self._file.flush()
+
+    def completed(self, path, output):
+        '''Was the input stretched to output by an earlier run, and is the output still there.'''
+        return (path, output) in self.done and os.path.exists(output)
+
+    def record(self, path, output, ok, seconds, message=''):
+        status = 'ok' if ok else 'failed'
+        self._writer.writerow([path, output, status, '%.3f' %seconds, message.strip().replace('\n', ' | ')])
+        self._file.flush()
+        if ok:
+            self.done.add((path, output))
+
+    def close(self):
+        self._file.close()
+
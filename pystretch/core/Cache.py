@@ -0,0 +1,74 @@
+"""
+Cache keeps the statistics of input bands between runs, so that stretching the
+same input several ways only scans each band once.
+
+Each entry is the merged RunningStats of a band from a streaming pass: the
+count, mean, M2, minimum, maximum and the fine histogram, from which any
+percentile can be estimated later.  Entries are stored in a cache directory,
+one .npz file per band, named by a hash of the absolute path, the size and
+modification time of the file, the band number and the no data value.  A
+changed input has a different key, so stale entries are never used.
+
+A preview, see GdalIO.preview, stores the statistics of the reduced band 
+under the key of the input, so the full resolution run uses the same ones.
+"""
+import hashlib
+import os
+import tempfile
+
+import numpy
+
+from pystretch.core import Stats
+
+
+class StatsCache(object):
+
+    def __init__(self, directory):
+        """Use, and create if needed, a cache directory."""
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def key(self, path, band, ndv):
+        """
+        The name of the entry of a band, or None if path is not a file, e.g. a
+        /vsi path, which can not be fingerprinted.
+        """
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        fingerprint = repr((os.path.abspath(path), stat.st_size, stat.st_mtime, band, ndv))
+        return hashlib.sha1(fingerprint).hexdigest()
+
+    def get(self, path, band, ndv):
+        """The cached RunningStats of a band, or None."""
+        key = self.key(path, band, ndv)
+        if key is None:
+            return None
+        filename = os.path.join(self.directory, key + '.npz')
+        if not os.path.exists(filename):
+            return None
+        entry = numpy.load(filename)
+        lower, upper = entry['range']
+        running = Stats.RunningStats(float(lower), float(upper), entry['hist'].size)
+        running.count = int(entry['count'])
+        running.mean, running.m2, running.minimum, running.maximum = [float(value) for value in entry['moments']]
+        running.hist = entry['hist']
+        return running
+
+    def put(self, path, band, ndv, running):
+        """
+        Store the RunningStats of a band.  The entry is written to a temporary
+        file and renamed, so concurrent runs never see a partial entry.
+        """
+        key = self.key(path, band, ndv)
+        if key is None:
+            return
+        handle, temporary = tempfile.mkstemp(suffix='.npz', dir=self.directory)
+        with os.fdopen(handle, 'wb') as f:
+            numpy.savez_compressed(f,
+                                   count=running.count,
+                                   moments=numpy.array([running.mean, running.m2, running.minimum, running.maximum]),
+                                   range=numpy.array([running.lower, running.upper], dtype=numpy.float64),
+                                   hist=running.hist)
+        os.rename(temporary, os.path.join(self.directory, key + '.npz'))
@@ -3,7 +3,13 @@ GdalIO to provide read and write capabilities leveraging GDAL.
 All GDAL supported file formats are supported via this FileIO.
 Consult the GDAL documentation for your version for a listing of the supported file formats.
 """
-from osgeo import gdal
+import argparse
+import os
+
+import numpy
+from osgeo import gdal, gdal_array
+
+from pystretch.core import Stats
 
 # set up some default nodatavalues for each datatype
 DefaultNDVLookup={'Byte':255, 'UInt16':65535, 'Int16':-32767, 'UInt32':4294967293, 'Int32':-2147483647, 'Float32':1.175494351E-38, 'Float64':1.7976931348623158E+308}
@@ -35,19 +41,276 @@ class GdalIO(object):
         
         return xsize, ysize, bands, projection, geotransform
     
-    def create_output(self,driverformat, outputname,xsize,ysize,bands,projection, geotransform, dtype):
+    def create_output(self,driverformat, outputname,xsize,ysize,bands,projection, geotransform, dtype, options=None):
 
-        """Method to create an output of the same type, size, projection, and transformation as the input dataset"""
+        """Method to create an output of the same type, size, projection, and transformation as the input dataset.
+        options is a list of driver creation options, NAME=VALUE strings."""
 
         if not outputname:
             outputname = "output.tif"
             
         if not driverformat:
-            driverFormat = 'Gtiff'
+            driverformat = 'GTiff'
 
-        driver = gdal.GetDriverByName(driverFormat)
-        outdataset = driver.Create(outputname, xsize, ysize, bands,dtype)
+        driver = gdal.GetDriverByName(driverformat)
+        if driver is None:
+            raise ValueError("%s is not a GDAL driver." %driverformat)
+        outdataset = driver.Create(outputname, xsize, ysize, bands,dtype, options or [])
         outdataset.SetProjection(projection)
         outdataset.SetGeoTransform(geotransform)
         
-        return outdataset
\ No newline at end of file
+        return outdataset
+
+
+def preview(dataset, size):
+    """Function to return an in memory copy of a dataset reduced so that its 
+    longest side is size pixels.  Each band is read from the smallest overview
+    which is at least that large, or decimated by GDAL if there are none, so
+    the full resolution data is not read.  The geotransform is scaled to match.
+    
+    Returns a MEM dataset."""
+
+    xsize = dataset.RasterXSize
+    ysize = dataset.RasterYSize
+    scale = min(float(size) / max(xsize, ysize), 1.0)
+    outx = max(int(round(xsize * scale)), 1)
+    outy = max(int(round(ysize * scale)), 1)
+
+    bands = dataset.RasterCount
+    mem = gdal.GetDriverByName('MEM').Create('', outx, outy, bands, dataset.GetRasterBand(1).DataType)
+    mem.SetProjection(dataset.GetProjection())
+    geotransform = list(dataset.GetGeoTransform())
+    geotransform[1] *= xsize / float(outx)
+    geotransform[2] *= ysize / float(outy)
+    geotransform[4] *= xsize / float(outx)
+    geotransform[5] *= ysize / float(outy)
+    mem.SetGeoTransform(geotransform)
+
+    for b in xrange(bands):
+        band = dataset.GetRasterBand(b+1)
+        source = band
+        for k in xrange(band.GetOverviewCount()):
+            overview = band.GetOverview(k)
+            if overview.XSize >= outx and overview.YSize >= outy and overview.XSize < source.XSize:
+                source = overview
+        array = source.ReadAsArray(0, 0, source.XSize, source.YSize, outx, outy)
+        outband = mem.GetRasterBand(b+1)
+        outband.WriteArray(array)
+        if band.GetNoDataValue() != None:
+            outband.SetNoDataValue(band.GetNoDataValue())
+    return mem
+
+
+def read_into(band, window, shared_arr):
+    """Function to read a window of a band directly into a shared buffer.  GDAL
+    converts the data to the type of the buffer, so there is no intermediate
+    array.
+
+    Returns the view of the buffer holding the window."""
+
+    (xstart, ystart, intervalx, intervaly) = window
+    shared_arr.reshape((intervaly, intervalx))
+    array = shared_arr.asarray()
+    band.ReadAsArray(xstart, ystart, intervalx, intervaly, buf_obj=array)
+    return Stats.signed_bytes(band, array)
+
+
+#The TIFF predictors by number, as the COG driver names them
+_cog_predictors = {1 : 'NO',
+                   2 : 'STANDARD',
+                   3 : 'FLOATING_POINT'}
+
+#The memory map of the raw output being written by this process, by file
+_memmaps = {}
+
+
+class MemmapOutput(object):
+    """A raw, band sequential output with an ENVI header which is written 
+    through numpy.memmap.  The workers copy their row slices straight into the
+    file, so there is no WriteArray per segment and the GDAL cache is not used.
+    GDAL writes the header, holding the georeferencing, so the output can be
+    opened by GDAL, e.g. as the input of another run."""
+
+    def __init__(self, outputname, xsize, ysize, bands, projection, geotransform, dtype):
+        driver = gdal.GetDriverByName('ENVI')
+        outdataset = driver.Create(outputname, xsize, ysize, bands, dtype, ['INTERLEAVE=BSQ'])
+        outdataset.SetProjection(projection)
+        outdataset.SetGeoTransform(geotransform)
+        outdataset = None
+
+        self.filename = outputname
+        self.shape = (bands, ysize, xsize)
+        self.dtype = numpy.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(dtype))
+
+        #The file is only as large as the data written to it, the map needs all of it
+        nbytes = bands * ysize * xsize * self.dtype.itemsize
+        with open(outputname, 'r+b') as f:
+            f.seek(0, 2)
+            if f.tell() < nbytes:
+                f.truncate(nbytes)
+
+    def settings(self, b, chunk, window):
+        """The arguments of write_memmap for band b of a segment read as window."""
+        return argparse.Namespace(filename=self.filename, dtype=self.dtype, shape=self.shape,
+                                  band=b, chunk=chunk, window=window)
+
+    def write(self, b, chunk, array):
+        """Write an array covering chunk into band b, as WriteArray."""
+        (xstart, ystart, intervalx, intervaly) = chunk
+        out = memmap(self.filename, self.dtype, self.shape)
+        out[b, ystart:ystart + intervaly, xstart:xstart + intervalx] = to_type(array, self.dtype)
+
+    def close(self):
+        """Flush the file to disk and open it with GDAL, to set the no data values."""
+        memmap(self.filename, self.dtype, self.shape).flush()
+        _memmaps.clear()
+        return gdal.Open(self.filename, gdal.GA_Update)
+
+
+def memmap(filename, dtype, shape):
+    """Function to return the, cached, memory map of a raw output.  Only the
+    map of the latest output is kept."""
+
+    stat = os.stat(filename)
+    key = (filename, stat.st_dev, stat.st_ino)
+    if key not in _memmaps:
+        #A process writes one output at a time, the workers never see close so
+        #the maps of earlier outputs, e.g. of a batch, are dropped here
+        _memmaps.clear()
+        _memmaps[key] = numpy.memmap(filename, dtype=dtype, mode='r+', shape=shape)
+    return _memmaps[key]
+
+
+def to_type(array, dtype):
+    """Function to convert an array to the output type as GDAL does, integer 
+    types are rounded and clipped to their range and NaN becomes 0."""
+
+    dtype = numpy.dtype(dtype)
+    if dtype.kind not in 'iu':
+        return array.astype(dtype)
+    info = numpy.iinfo(dtype)
+    array = numpy.nan_to_num(array)
+    return numpy.clip(numpy.rint(array), info.min, info.max).astype(dtype)
+
+
+def write_memmap(shared_array, i, args):
+    """Worker function to write the rows of a slice of a segment, without the 
+    halo, into a MemmapOutput.  args is from MemmapOutput.settings."""
+
+    (xstart, ystart, intervalx, intervaly) = args.chunk
+    (readx, ready, readcolumns, readrows) = args.window
+    first = max(i.start, ystart - ready)
+    last = min(i.stop, ystart - ready + intervaly)
+    if last <= first:
+        return
+    arr = shared_array.asarray()
+    rows = arr[first:last, xstart - readx:xstart - readx + intervalx]
+    out = memmap(args.filename, args.dtype, args.shape)
+    out[args.band, ready + first:ready + last, xstart:xstart + intervalx] = to_type(rows, args.dtype)
+
+
+def creation_options(tiled=False, blocksize=512, compress=None, predictor=None, bigtiff=None, extra=None):
+    """Function to return the GeoTIFF creation options of an output profile as
+    a list of NAME=VALUE strings.  extra options, as given to gdal_translate
+    -co, are added last and take precedence."""
+
+    options = []
+    if tiled:
+        options += ['TILED=YES', 'BLOCKXSIZE=%i' %blocksize, 'BLOCKYSIZE=%i' %blocksize]
+    if compress:
+        options.append('COMPRESS=%s' %compress.upper())
+    if predictor:
+        options.append('PREDICTOR=%i' %predictor)
+    if bigtiff:
+        options.append('BIGTIFF=%s' %bigtiff.upper())
+    if extra:
+        options += extra
+    return options
+
+
+def overview_factors(xsize, ysize, minsize=256):
+    """Function to return the overview decimation factors, 2, 4, 8..., until the
+    overview fits in minsize pixels, as gdaladdo and the COG driver do."""
+
+    factors = []
+    factor = 2
+    while max(xsize, ysize) > minsize * factor // 2:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def create_overviews(dataset, factors, compress=None, predictor=None):
+    """Function to create empty internal overviews in an output which are filled
+    by write_overviews as each segment is written, so the output is never read
+    back to build them."""
+
+    #The options are process wide, so the previous values are restored
+    options = {}
+    if compress:
+        options['COMPRESS_OVERVIEW'] = compress.upper()
+    if predictor:
+        options['PREDICTOR_OVERVIEW'] = str(predictor)
+    previous = dict([(key, gdal.GetConfigOption(key)) for key in options])
+    try:
+        for key, value in options.iteritems():
+            gdal.SetConfigOption(key, value)
+        dataset.BuildOverviews('NONE', factors)
+    finally:
+        for key, value in previous.iteritems():
+            gdal.SetConfigOption(key, value)
+
+
+def write_overviews(band, array, chunk, factors, resampling='average', ndv=None):
+    """Function to write the overviews of a segment of a band.  Segments must 
+    start on multiples of the largest factor, see Segment.align_segments.  
+    Average resampling ignores NaN and the no data value ndv, blocks with no
+    other pixels are ndv."""
+
+    (xstart, ystart, intervalx, intervaly) = chunk
+    for k, factor in enumerate(factors):
+        overview = band.GetOverview(k)
+        if resampling == 'nearest':
+            reduced = array[::factor, ::factor]
+        else:
+            rows = -(-intervaly // factor)
+            columns = -(-intervalx // factor)
+            #float32 holds Byte and 16-bit data exactly, wider types need float64
+            padded = numpy.empty((rows * factor, columns * factor), dtype=numpy.result_type(array.dtype, numpy.float32))
+            padded[...] = numpy.nan
+            padded[:intervaly, :intervalx] = array
+            if ndv is not None:
+                padded[padded == ndv] = numpy.nan
+            blocks = padded.reshape(rows, factor, columns, factor)
+            #Pixels and blocks which are all NaN stay NaN, or no data
+            valid = numpy.isfinite(blocks).sum(axis=(1, 3))
+            reduced = numpy.nansum(blocks, axis=(1, 3)) / numpy.maximum(valid, 1)
+            reduced[valid == 0] = numpy.nan if ndv is None else ndv
+            reduced = to_type(reduced, array.dtype)
+        xoff = xstart // factor
+        yoff = ystart // factor
+        reduced = reduced[:overview.YSize - yoff, :overview.XSize - xoff]
+        overview.WriteArray(reduced, xoff, yoff)
+
+
+def translate_cog(dataset, outputname, compress=None, predictor=None, bigtiff=None, blocksize=512, extra=None):
+    """Function to copy a tiled output with internal overviews into the Cloud 
+    Optimized GeoTIFF layout, the overviews are copied rather than rebuilt.  
+    Without the COG driver, GDAL < 3.1, the GeoTIFF driver copies with 
+    COPY_SRC_OVERVIEWS which gives the same layout."""
+
+    driver = gdal.GetDriverByName('COG')
+    if driver is not None:
+        options = ['BLOCKSIZE=%i' %blocksize, 'OVERVIEWS=FORCE_USE_EXISTING']
+        if compress:
+            options.append('COMPRESS=%s' %compress.upper())
+        if predictor:
+            options.append('PREDICTOR=%s' %_cog_predictors.get(predictor, 'YES'))
+        if bigtiff:
+            options.append('BIGTIFF=%s' %bigtiff.upper())
+    else:
+        driver = gdal.GetDriverByName('GTiff')
+        options = creation_options(True, blocksize, compress, predictor, bigtiff) + ['COPY_SRC_OVERVIEWS=YES']
+    if extra:
+        options += extra
+    return driver.CreateCopy(outputname, dataset, 0, options)
@@ -0,0 +1,90 @@
+"""
+Lookup provides a lookup table (LUT) fast path for 8 and 16-bit integer inputs.
+
+Point stretches are a pure function of the pixel value, so for 8 and 16-bit
+integer data the stretch, denormalization, scaling and no data handling
+are evaluated once over the 256 or 65,536 possible input values.  Every segment
+is then stretched with a single numpy.take on the native array, without a 
+float working copy.
+"""
+import numpy
+
+from pystretch.core import ArrayConvert, Stats
+
+#Stretches which depend only on the value of a pixel and the band statistics
+_pointwise = ['linear_stretch',
+              'standard_deviation_stretch',
+              'inverse_stretch',
+              'binary_stretch',
+              'hicut_stretch',
+              'lowcut_stretch',
+              'gamma_stretch',
+              'logarithmic_stretch']
+
+#The values of each input type, [low, high)
+_lut_ranges = {'Byte' : (0, 256),
+               's8' : (-128, 128),
+               'UInt16' : (0, 65536),
+               'Int16' : (-32768, 32768)}
+
+
+def supported(stretch, datatype, args):
+    '''
+    Check if a stretch can be applied with a LUT to an input of GDAL type name
+    datatype.  Statistics calculated per segment change the stretch from one
+    segment to the next, so they can not use a LUT.
+    '''
+    return (args.lut == True and
+            datatype in _lut_ranges and
+            stretch.__name__ in _pointwise and
+            args.segment == False)
+
+
+def build_lut(stretch, datatype, dtype, args):
+    '''
+    Evaluate the stretch over every value of the input type, exactly as main
+    processes a segment: no data, normalize, stretch, denorm and scale.
+
+    datatype is the type name of the input, see Stats.band_datatype, and dtype
+    that of the output.  The band statistics must already be set in args.
+
+    Returns the LUT as an array of the output type.  It is indexed by the 
+    value, negative values from the end as numpy.take does, so signed data
+    is looked up without being widened.
+    '''
+    low, high = _lut_ranges[datatype]
+    values = numpy.arange(low, high, dtype=numpy.float32)
+
+    ndv = args.ndv_band if args.ndv_band != None else args.ndv
+    nodata = numpy.zeros(values.size, dtype=bool)
+    if ndv != None and ndv == int(ndv) and low <= ndv < high:
+        nodata[int(ndv) - low] = True
+
+    values = Stats.normalize(values, args.bandmin, args.bandmax, dtype)
+    args.normalized = True
+
+    shared_array = ArrayConvert.SharedMemArray(values)
+    stretch(shared_array, slice(None), args)
+    lut = shared_array.asarray()
+
+    Stats.denorm(lut, dtype, args)
+    if args.scale != None:
+        Stats.scale(lut, args)
+
+    #No data maps to the output no data value, as does anything the stretch left undefined
+    outndv = args.ndv if args.ndv != None else args.ndv_band
+    nodata |= ~numpy.isfinite(lut)
+    lut[nodata] = outndv if outndv != None else 0
+
+    #Match GDAL, which rounds and clamps when writing floats to an integer band
+    outtype = numpy.dtype(Stats.datatype(dtype))
+    if outtype.kind in 'iu':
+        info = numpy.iinfo(outtype)
+        numpy.round(lut, out=lut)
+        numpy.clip(lut, info.min, info.max, out=lut)
+    return numpy.roll(lut, low).astype(outtype)
+
+
+def apply_lut(lut, array):
+    '''Stretch a native integer array with the LUT.'''
+    return numpy.take(lut, array)
@@ -0,0 +1,69 @@
+"""
+NoData keeps the no data pixels of a segment as a packed bit mask beside it in
+its shared buffer, see SharedMemBuffer.mask_asarray.  The mask takes one bit a
+pixel, an eighth of a bool array, and the workers see it as they see the data.
+
+A set bit is a valid pixel.  The bits are packed in row major order over the
+whole segment, so the bits of neighbouring rows can share a byte.  The workers
+mark the mask on row slices which start at a multiple of 8 rows, see slices,
+so no two of them ever write the same byte, and any worker can read the bits
+of any rows with valid.
+
+Statistics leave the invalid pixels out and the last step of a chain writes
+the output no data value over them, see Steps.point_ops, so no data is never
+NaN.  Only filters, which would otherwise read no data as data, may be given
+the invalid pixels as NaN, see mark.
+"""
+import numpy
+
+
+def slices(pool, rows):
+    '''Split rows into one row slice per worker, each starting at a multiple of 8 rows.'''
+    step = max(rows // pool.processes, 1)
+    step = (step + 7) // 8 * 8
+    return [slice(i, i+step) for i in xrange(0, rows, step)]
+
+
+def _span(shape, i):
+    '''The first and last, exclusive, pixel of the rows i of an array of shape.'''
+    start, stop, step = i.indices(shape[0])
+    columns = int(numpy.prod(shape[1:]))
+    return start * columns, max(start, stop) * columns
+
+
+def pack(shared_array, i, valid):
+    '''
+    Write the valid pixels of the rows i, a bool array, to the mask.  The
+    rows must start at a multiple of 8 rows and end on one or at the last row.
+    '''
+    first, last = _span(shared_array.shape, i)
+    shared_array.mask_asarray()[first // 8:(last + 7) // 8] = numpy.packbits(valid.reshape(-1))
+
+
+def valid(shared_array, i):
+    '''The valid pixels of the rows i as a bool array of their shape.'''
+    shape = shared_array.shape
+    first, last = _span(shape, i)
+    bits = numpy.unpackbits(shared_array.mask_asarray()[first // 8:(last + 7) // 8])
+    offset = first % 8
+    start, stop, step = i.indices(shape[0])
+    return bits[offset:offset + last - first].view(bool).reshape((max(stop - start, 0),) + tuple(shape[1:]))
+
+
+def mark(shared_array, i, args):
+    '''
+    Worker function which marks the pixels of the rows i which are neither
+    args.ndv nor NaN as valid.  The invalid pixels are set to NaN if
+    args.fill.
+
+    Returns the number of invalid pixels.
+    '''
+    arr = shared_array.asarray()[i]
+    ok = numpy.not_equal(arr, args.ndv)
+    if arr.dtype.kind == 'f':
+        ok &= ~numpy.isnan(arr)
+    pack(shared_array, i, ok)
+    invalid = ok.size - int(numpy.count_nonzero(ok))
+    if args.fill and invalid and arr.dtype.kind == 'f':
+        arr[~ok] = numpy.nan
+    return invalid
@@ -4,7 +4,26 @@ from pystretch.nonlinear import Nonlinear
 from pystretch.filter import Filter
 from pystretch.custom import Custom
 
+_memory_units = {'K' : 1024,
+                 'M' : 1024 ** 2,
+                 'G' : 1024 ** 3,
+                 'T' : 1024 ** 4}
+
+def memory_size(value):
+    '''Convert a size with an optional K, M, G or T suffix, e.g. 2G, into bytes.'''
+    value = value.strip().upper().rstrip('B')
+    try:
+        if value and value[-1] in _memory_units:
+            return int(float(value[:-1]) * _memory_units[value[-1]])
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not a memory size, e.g. 512M or 2G' %value)
+
 def parse_arguments():
+    return(get_parser().parse_args())
+
+def get_parser():
+    '''The command line parser.  Its defaults are also the settings of the library API.'''
     
     desc='''Description: %prog leverages GDAL and NUMPY to stretch raster images.  GDAL 1.8.0 and NUMPY 1.5.1 or greater are required. Both linear and non-linear stretches are available.'''
     
@@ -16,19 +35,54 @@ def parse_arguments():
     nonlinearstretches = parser.add_argument_group('Non-linear Stretches')
     filters = parser.add_argument_group('Filters')
     custom = parser.add_argument_group('Custom')
+    chain = parser.add_argument_group('Chaining')
+    outputOptions = parser.add_argument_group('Output Options')
+    batchOptions = parser.add_argument_group('Batch Options')
     
     generalOptions.add_argument('input_data', action='store', help='The input data set to be processed.')
     generalOptions.add_argument('--output', '-o',action='store',default='output.tif',type=str,dest='output',help='The optional output file')
     generalOptions.add_argument('--format', '-f',action='store',type=str,default='GTiff', dest="outputFormat" ,help='Any GDAL supported output format.') 
     generalOptions.add_argument('--ot', action='store', type=str, dest='dtype',default=None, help='A GDAL output format. (Byte, Int16, Float32 are likely candidates.' )
+    generalOptions.add_argument('--memmap', action='store_true', default=False, dest='memmap', help='Write the output as a raw, band sequential, file with an ENVI header.  The workers write straight into the file through memory maps.  GDAL reads the output, so it can be the input of another run.  Overrides --format.')
+    generalOptions.add_argument('--gdal-cache', action='store', type=memory_size, default=2147483648, dest='gdal_cache', help='The size of the GDAL block cache, e.g. 512M.  Defaults to 2G.')
+    generalOptions.add_argument('--preview', action='store', type=int, default=None, dest='preview', metavar='N', help='Stretch a preview, N pixels on the longest side, read from the overviews of the input or decimated if it has none.  The statistics are those of the preview, unless they are in the --stats-cache.  With --stats-cache they are cached, so the full resolution run with the same settings uses them and matches the preview.')
     generalOptions.add_argument('--visualize', '-z', action='store_true', default=False, dest='visualize', help='show the output histogram.')
     generalOptions.add_argument('--NDV', action='store', dest='ndv', type=float, help='Define an output NDV.  If the dataset has an NDV, this value and the intrinsic NDV are set to No Data in the output.  The output NDV is this value.')    
     generalOptions.add_argument('--scale','-s', action='store', dest='scale',nargs=2, type=str, help='Scale the data to 8-bit')
+    generalOptions.add_argument('--nolut', action='store_false', default=True, dest='lut', help='Do not use a lookup table for point stretches of 8 and 16-bit integer data.  The stretch is then computed per pixel in float32.')
+    generalOptions.add_argument('--backend', action='store', choices=['processes', 'threads'], default='processes', dest='backend', help='Stretch in worker processes, with the data in shared memory, or in threads working on the arrays in place.  Threads avoid copies and process startup, NumPy and SciPy release the GIL for most of the work.')
+    generalOptions.add_argument('--stats-cache', action='store', type=str, default=None, dest='stats_cache', metavar='DIR', help='Keep the band statistics, with a fine histogram for the percentiles, in a cache directory.  Each band is scanned once and later runs on the same, unchanged, input reuse the statistics.')
+    generalOptions.add_argument('--approx-stats', action='store', type=float, nargs='?', const=0.05, default=None, dest='approx_stats', metavar='FRACTION', help='Estimate the band statistics from a stratified random sample of this fraction of the blocks, 0.05 if not given, and report the estimated error of the mean, of the standard deviation and of the --clip bounds.')
+    generalOptions.add_argument('--approx-source', action='store', choices=['blocks', 'overview'], default='blocks', dest='approx_source', help='Estimate the statistics from sampled blocks or from the coarsest overview, if there is one.')
+    generalOptions.add_argument('--approx-tolerance', action='store', type=float, default=None, dest='approx_tolerance', help='Fall back to exact statistics if the 95%% confidence interval of the mean, the standard deviation or a --clip bound is wider than this fraction of the band range, e.g. 0.01.  Exact statistics are always calculated if the sample is a single window, whose error can not be estimated.')
+    generalOptions.add_argument('--processes', action='store', type=int, default=None, dest='processes', help='The number of workers.  Defaults to twice the number of cores for processes and the number of cores for threads.')
+    generalOptions.add_argument('--timings', action='store', type=str, default=None, dest='timings', metavar='FILE', help='Write the total time, the time spent in each stage, e.g. stats, read, compute, normalize, stretch and write, and the time the workers spent in each task to a JSON file.  Stages overlap when segments are pipelined.')
+    generalOptions.add_argument('--trace', action='store', type=str, default=None, dest='trace', metavar='FILE', help='Write every stage of every band and segment, and every task of every worker, with its start and duration to a trace.  CSV if FILE ends in .csv, otherwise JSON.')
+    generalOptions.add_argument('--profile-worker', action='store', type=str, default=None, dest='profile_worker', metavar='FILE', help='Run the first worker under cProfile and write its statistics to FILE, to be read with pstats.')
     generalOptions.add_argument('--segment', '--seg', action='store_true', default=False, dest='segment', help='Use this flag to calculate statistics per segment instead of per band.  Best for removing spatially describale systematic error.')
     
+    outputOptions.add_argument('--co', action='append', type=str, dest='creation_options', default=None, metavar='NAME=VALUE', help='A driver creation option, as gdal_translate -co.  May be repeated.')
+    outputOptions.add_argument('--tiled', action='store_true', default=False, dest='tiled', help='Write a tiled GeoTIFF.')
+    outputOptions.add_argument('--blocksize', action='store', type=int, default=512, dest='blocksize', help='The tile size of tiled and COG outputs.  Defaults to 512.')
+    outputOptions.add_argument('--compress', action='store', type=str, default=None, dest='compress', help='The GeoTIFF compression codec, e.g. DEFLATE, LZW, ZSTD or JPEG.')
+    outputOptions.add_argument('--predictor', action='store', type=int, choices=[1, 2, 3], default=None, dest='predictor', help='The GeoTIFF predictor, 2 for integer and 3 for floating point data.')
+    outputOptions.add_argument('--bigtiff', action='store', type=str, choices=['YES', 'NO', 'IF_NEEDED', 'IF_SAFER'], default=None, dest='bigtiff', help='Write a BigTIFF.')
+    outputOptions.add_argument('--cog', action='store_true', default=False, dest='cog', help='Write a Cloud Optimized GeoTIFF, tiled with internal overviews.')
+    outputOptions.add_argument('--overviews', action='store', type=int, nargs='*', default=None, dest='overviews', help='Build internal overviews from the stretched segments as they are written.  Give the factors, e.g. 2 4 8 16, or none to halve until the overview fits in a block, see --blocksize.  Not available with --memmap.')
+    outputOptions.add_argument('--overview-resampling', action='store', choices=['average', 'nearest'], default='average', dest='overview_resampling', help='The overview resampling.  Defaults to average.')
+    
+    batchOptions.add_argument('--batch', action='store_true', default=False, dest='batch', help='Stretch many inputs with one pool.  The input is then a quoted glob, @file with a list of paths, or a JSON manifest, see pystretch.core.Batch.')
+    batchOptions.add_argument('--output-template', action='store', type=str, default='{dir}/{name}_stretched.tif', dest='output_template', help='The output of each input of a batch, {dir}, {name} and {ext} are those of the input.  Defaults to {dir}/{name}_stretched.tif')
+    batchOptions.add_argument('--report', action='store', type=str, default='pystretch_report.csv', dest='report', help='The CSV report of a batch.  Inputs reported as stretched, whose output exists, are skipped when the batch is run again.')
+    batchOptions.add_argument('--batch-small', action='store', type=int, default=4194304, dest='batch_small', help='Inputs with at most this many pixels, over all bands, are stretched whole in a single worker process, many at once.  Larger inputs, and every input with the threads backend, are split across the workers one at a time.')
+    
+    chain.add_argument('--step', action='append', type=str, dest='steps', default=None, help='Add a step to a chain of stretches applied in a single pass, e.g. --step median_filter:kernel_size=5 --step linear_stretch:clip=2 --step gamma_stretch.  Names are those in pystretch.core.OptParse.stretches, options are any other setting by its dest name.')
+    chain.add_argument('--recipe', action='store', type=str, dest='recipe', default=None, help='A JSON file listing the steps of a chain, e.g. [{"stretch": "median_filter", "kernel_size": 5}, {"stretch": "gamma_stretch"}].')
+    
     custom.add_argument('--custom', action='store_true', default=False, dest='custom_stretch', help='Use this flag to call your own custom stretch.  You will need to code it into the custom_stretch function inside the Custom module')
     
     directionOptions.add_argument('--horizontal', '-t', action='store',type=int, dest='hint', default=1, help='The number of horizontal segments to divide the image into.  This will likely leave a small "remainder" segment at the edge of the image.')
+    directionOptions.add_argument('--memory-budget', action='store', type=memory_size, dest='memory_budget', default=None, help='The amount of RAM to use, e.g. 512M or 2G.  The image is segmented into windows aligned to the native blocks of the dataset which fit the budget.  Overrides -t and -v.')
     directionOptions.add_argument('--vertical', '-v', action='store', type=int, dest ='vint', default=1, help='The number of vertical segments to divide the image into.  This will likely leave a small "remainder" segment at the edge of the image.')
     
     linearStretches.add_argument('--std', '-d', action='store_true', dest='standard_deviation_stretch',default=False,help='Perform a standard deviation stretch with default n=2. Set "-n <float> to specify a different number of standard deviations.')
@@ -47,6 +101,9 @@ def parse_arguments():
     nonlinearstretches.add_argument('--gammavalue', '--gv', action='store', type=float, default=1.6, dest='gammavalue', help='The gamma value to be used.  Processed as 1/gamma.')
     nonlinearstretches.add_argument('--histogramequalization', '-q', action='store_true', default=False, dest='histequ_stretch', help='Perform a histogram equalization.  It is suggested that sample size be set to 1 to ensure that the entire image is processed.  Default number of bins is 128, to change this set "-b <integer number of bins>".')
     nonlinearstretches.add_argument('--bins', '-b', action='store', type=int, default=128, dest='num_bins', help='The number of bins to be used with the histogram equalization.')
+    nonlinearstretches.add_argument('--clahe', action='store_true', default=False, dest='clahe_stretch', help='Perform a contrast limited adaptive histogram equalization.  The band is divided into a grid of tiles, set with "--tiles <integer>", and each pixel is equalized by the histograms of the tiles around it, blended by its distance to them.  The number of bins is set with "-b <integer number of bins>".')
+    nonlinearstretches.add_argument('--tiles', action='store', type=int, default=8, dest='tiles', help='The number of tiles across and down the band for the adaptive histogram equalization.')
+    nonlinearstretches.add_argument('--cliplimit', action='store', type=float, default=2.0, dest='clip_limit', help='The contrast limit of the adaptive histogram equalization, as a multiple of the mean count of a histogram bin.  0 for no limit.')
     nonlinearstretches.add_argument('--log', '-r', action='store_true', dest='logrithmic_stretch', default=False, help='Performs a logrithmic stretch with default epsilon of 1.  This is most likely appropriate for images with magnitudes typically much larger than 1.  To modify epsilon use "-e <float epsilon value>".')
     nonlinearstretches.add_argument('--epsilon', '-e', action='store', type=float, default=1, dest='epsilon', help='The desired epsilon value.')
     #nonlinearstretches.add_argument('--gaussian', '-u', action='store_true', default=False, dest='gaussian_stretch', help='Performs a gaussian stretch.')
@@ -63,8 +120,35 @@ def parse_arguments():
     filters.add_argument('--kernelsize', '-k', action='store', default=3, type=int, dest='kernel_size', help='A positive, odd, integer which is the size of the kernel to be created')
     filters.add_argument('--median', '--md', action='store_true', default=False, dest='median_filter', help='Perform a median filtering of the input image with default 3x3 kernel.  Specify -k int, where int is an odd integer for a larger kernel')
     
-    return(parser.parse_args())
+    return(parser)
+
+
+#The stretches by the dest of their flag
+stretches = {'linear_stretch' : Linear.linear_stretch,
+             'standard_deviation_stretch' : Linear.standard_deviation_stretch,
+             'inverse_stretch' : Linear.inverse_stretch,
+             'binary_stretch' : Linear.binary_stretch,
+             'hicut_stretch' : Linear.hicut_stretch,
+             'lowcut_stretch' : Linear.lowcut_stretch,
+             'gamma_stretch' : Nonlinear.gamma_stretch,
+             'histequ_stretch' : Nonlinear.histequ_stretch,
+             'clahe_stretch' : Nonlinear.clahe_stretch,
+             'logrithmic_stretch' : Nonlinear.logarithmic_stretch,
+             'mean_filter' : Filter.mean_filter,
+             'median_filter' : Filter.median_filter,
+             'laplacian_filter' : Filter.laplacian_filter,
+             'hipass_filter_3x3' : Filter.hipass_filter_3x3,
+             'hipass_filter_5x5' : Filter.hipass_filter_5x5,
+             'gaussian_filter' : Filter.gaussian_filter,
+             'gaussian_hipass' : Filter.gaussian_hipass,
+             'conservative_filter' : Filter.conservative_filter,
+             'custom_stretch' : Custom.custom_stretch}
 
+def defaults():
+    '''A Namespace holding the default of every setting, as if given no flags.'''
+    args = get_parser().parse_args([''])
+    args.input_data = None
+    return args
 
 #This needs to get cleanup / improved.  It would be better to use the dict function in ArrayConvert.
 def get_stretch(args):
@@ -84,6 +168,8 @@ def get_stretch(args):
         return Nonlinear.gamma_stretch
     elif args.histequ_stretch == True:
         return Nonlinear.histequ_stretch
+    elif args.clahe_stretch == True:
+        return Nonlinear.clahe_stretch
     elif args.mean_filter == True:
         return Filter.mean_filter
     elif args.median_filter == True:
@@ -0,0 +1,123 @@
+"""
+Pipeline overlaps reading, stretching and writing of image segments.
+
+Three stages run at once:
+    - a reader thread prefetches segment N+1 from disk,
+    - the calling thread stretches segment N in a shared buffer of the WorkerPool,
+    - a writer thread writes segment N-1 back to disk.
+
+The reader takes a free buffer before reading a segment, so the segment can be
+read straight into shared memory, and the buffer is released once the segment
+is written.  The buffers are the only copies of the segments in flight, the
+pool needs three for all of the stages to overlap.  The prefetch and write
+behind queues are also bounded by depth.  When every band of a segment is 
+processed together each segment takes width buffers, and slot k is buffers 
+k*width to (k+1)*width-1.
+
+GDAL datasets are not safe to share between threads.  The read function should
+be the only user of the input dataset and the write function the only user of
+the output dataset while the pipeline is running.
+"""
+import Queue
+import sys
+import threading
+
+
+class Pipeline(object):
+
+    def __init__(self, pool, depth=2, width=1):
+        self.pool = pool
+        self.depth = depth
+        self.width = width
+
+    def run(self, segments, read, compute, write=None):
+        """
+        Process every segment, blocking until the last one is written.
+
+        read(chunk, slot) is called in the reader thread, it may read into
+        pool.buffers[slot] and returns an array, or anything else compute needs.
+        compute(chunk, array, slot) is called in this thread, it may use
+        pool.buffers[slot] and returns the array to be written.
+        write(chunk, result) is called in the writer thread, the buffer is not
+        reused until it returns.  If write is None the buffer is released as
+        soon as compute returns.
+
+        An exception raised in any stage stops the pipeline and is raised here.
+        """
+        self._errors = []
+        self._stop = threading.Event()
+        prefetch = Queue.Queue(maxsize=self.depth)
+        writebehind = Queue.Queue(maxsize=self.depth)
+        free = Queue.Queue()
+        for slot in xrange(len(self.pool.buffers) // self.width):
+            free.put(slot)
+
+        reader = threading.Thread(target=self._read, args=(segments, read, prefetch, free))
+        writer = threading.Thread(target=self._write, args=(write, writebehind, free))
+        reader.daemon = writer.daemon = True
+        reader.start()
+        writer.start()
+
+        try:
+            while True:
+                item = prefetch.get()
+                if item is None or self._stop.is_set():
+                    break
+                chunk, slot, array = item
+                result = compute(chunk, array, slot)
+                del item, array
+                writebehind.put((chunk, slot, result))
+                del result
+        except:
+            self._errors.append(sys.exc_info())
+        finally:
+            #Unblock the reader if it is waiting on a full queue, then flush the writer
+            self._stop.set()
+            while reader.is_alive():
+                try:
+                    prefetch.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+            writebehind.put(None)
+            writer.join()
+
+        if self._errors:
+            exc_type, exc_value, tb = self._errors[0]
+            raise exc_type, exc_value, tb
+
+    def _read(self, segments, read, prefetch, free):
+        try:
+            for chunk in segments:
+                slot = self._acquire(free)
+                if slot is None:
+                    break
+                prefetch.put((chunk, slot, read(chunk, slot)))
+        except:
+            self._errors.append(sys.exc_info())
+        prefetch.put(None)
+
+    def _acquire(self, free):
+        #Wait for a free buffer, or None if the pipeline is stopped
+        while not self._stop.is_set():
+            try:
+                return free.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        return None
+
+    def _write(self, write, writebehind, free):
+        while True:
+            item = writebehind.get()
+            if item is None:
+                break
+            chunk, slot, result = item
+            del item
+            try:
+                #Once a stage has failed keep releasing buffers, but stop writing
+                if write is not None and not self._errors:
+                    write(chunk, result)
+            except:
+                self._errors.append(sys.exc_info())
+                self._stop.set()
+            del result
+            free.put(slot)
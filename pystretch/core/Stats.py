@@ -1,11 +1,21 @@
+import argparse
 import numpy
 import gc
 import time
 
+from pystretch.core import NoData
+
+try:
+    from osgeo import gdal
+except ImportError:
+    #Only band statistics need GDAL, arrays can be stretched without it
+    gdal = None
+
 
 _datatype_integer_ranges = {
     'Byte' : [0, 255],
     's8' : [-128,127],
+    'Int8' : [-128,127],
     'UInt16' : [0, 65535],
     'Int16' : [-32768, 32767],
     'UInt32' : [0, 4294967295],
@@ -13,12 +23,18 @@ _datatype_integer_ranges = {
     'Float32' : [-3.402823466**38, 3.402823466**38 ]
     }
 
-_gdal_to_numpy = { 'Byte': numpy.int8,
+#Float data is not normalized
+_float_types = ['Float32', 'Float64']
+
+_gdal_to_numpy = { 'Byte': numpy.uint8,
+                   's8' : numpy.int8,
+                   'Int8' : numpy.int8,
                    'Int16' : numpy.int16,
                    'UInt16' : numpy.uint16,
                    'Int32' : numpy.int32,
                    'UInt32' : numpy.uint32,
-                   'Float32' : numpy.float32 
+                   'Float32' : numpy.float32,
+                   'Float64' : numpy.float64
                    }
 
 def datatype(dtype):
@@ -35,21 +51,50 @@ def datatype(dtype):
     
     return arraytype
 
-def denorm(array, dtype, args):
+def band_datatype(band):
+    '''
+    The data type name of a band, as gdal.GetDataTypeName, except for signed 
+    bytes which are s8.  GDAL 3.7 and later has an Int8 type, before that they
+    are Byte bands with a SIGNEDBYTE pixel type.
+    '''
+    name = gdal.GetDataTypeName(band.DataType)
+    if name == 'Int8':
+        return 's8'
+    if name == 'Byte' and band.GetMetadataItem('PIXELTYPE', 'IMAGE_STRUCTURE') == 'SIGNEDBYTE':
+        return 's8'
+    return name
+
+def signed_bytes(band, array):
+    '''
+    Before GDAL 3.7 a signed byte band is read as unsigned into any array but
+    an int8 one.  Wrap the values of a wider array read from such a band back
+    to -128 to 127.
+    '''
+    if array.dtype.itemsize > 1 and band.DataType == gdal.GDT_Byte and band_datatype(band) == 's8':
+        array[array > 127] -= 256
+    return array
 
+def denormalization(dtype, args):
+    '''
+    The factor denorm multiplies by, or None if the output is left as it is.
+    '''
     #Do not attempt to rescale the histogram equalization
     if args.histequ_stretch == True:
-        pass
+        return None
     
     #We do not normalize float, so do not rescale
-    elif dtype == 'Float32':
-        pass
+    elif dtype in _float_types:
+        return None
     
     #Everything else needs to be rescaled
-    else:
-        for key, value in _datatype_integer_ranges.iteritems():
-            if dtype == key:
-                array *= value[1]
+    elif dtype in _datatype_integer_ranges:
+        return float(_datatype_integer_ranges[dtype][1])
+    return None
+
+def denorm(array, dtype, args):
+    factor = denormalization(dtype, args)
+    if factor is not None:
+        array *= factor
     del  array
     gc.collect()
     
@@ -57,28 +102,20 @@ def denorm(array, dtype, args):
 def get_array_stats(array, stretch ):
     '''
     Calculates the statistics from a numpy array and returns a dictionary containing:
-    mean, maximum, minimum, and potentially standard deviation.
+    mean, maximum, minimum, and standard deviation.
     
-    Standard deviation is not calculated by devault as it duplicates the array in
-    memory.  A fast implementation of the Welford Algorithm is being sought as a 
-    replacement to numpy.std(array) or array.std()
+    The statistics are accumulated with the Welford Algorithm, see RunningStats, 
+    so the array is not duplicated in memory as it is by numpy.std(array).
     
-    Returns a dictionary with mean, maximum, minimum, and possibly standard deviation
+    Returns a dictionary with mean, maximum, minimum, and standard deviation
     '''
+    running = RunningStats()
+    running.update(array)
     stats = {}
-    stats['mean'] = float(array.mean())
-    stats['maximum'] = float(array.max())
-    stats['minimum'] = float(array.min())
-    gc.collect()
-    #Standard Deviation takes a few seconds to calculate.  Skip it if you do not need it. Worse - numpy.std makes an in memory copy of the array...
-    try:
-        if stretch.__name__ == 'standard_deviation_stretch' or 'gaussian_stretch':
-            #TODO Look at fast implementations of the Welford Algorithm
-            std = array.std()
-            stats['standard_deviation'] = float(std)
-            del std
-    except:
-        pass
+    stats['mean'] = running.mean
+    stats['maximum'] = running.maximum
+    stats['minimum'] = running.minimum
+    stats['standard_deviation'] = running.std()
     
     del array
     gc.collect()
@@ -129,6 +166,517 @@ def get_band_stats(band,args):
  
     return stats
 
+class RunningStats(object):
+    '''
+    Streaming, mergeable statistics for an image.
+    
+    The count, mean, sum of squared differences from the mean (M2), minimum and 
+    maximum are updated with the Welford Algorithm and merged with the parallel 
+    form from Chan et al., so partial statistics computed by different workers
+    on different segments can be combined in any order.  An optional fixed bin
+    histogram over (lower, upper) is accumulated alongside and is used to 
+    estimate percentiles without sorting the image.
+    
+    NaN and infinity are skipped, as are the pixels which are not valid if a
+    no data mask is given, see update.  Integer arrays are accepted as they
+    are.
+    '''
+    
+    #The number of elements processed at once, this bounds the temporary copies
+    blocksize = 1048576
+    
+    def __init__(self, lower=None, upper=None, num_bins=0):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = numpy.inf
+        self.maximum = -numpy.inf
+        self.lower = lower
+        self.upper = upper
+        self.hist = numpy.zeros(num_bins, dtype=numpy.int64)
+    
+    def update(self, array, valid=None):
+        '''
+        Add the values of an array (or masked array) to the statistics.  If
+        valid, a bool array of the same shape, is given only the values where
+        it is set are added.
+        '''
+        if isinstance(array, numpy.ma.MaskedArray):
+            array = array.compressed()
+        flat = array.reshape(-1)
+        if valid is not None:
+            valid = valid.reshape(-1)
+        for start in xrange(0, flat.size, self.blocksize):
+            values = flat[start:start + self.blocksize]
+            if valid is not None:
+                values = values[valid[start:start + self.blocksize]]
+            if values.dtype.kind == 'f':
+                values = values[numpy.isfinite(values)]
+            else:
+                #Integer buffers hold no NaN, the histogram is filled in float
+                values = values.astype(numpy.float64)
+            if values.size == 0:
+                continue
+            chunk = RunningStats(self.lower, self.upper, self.hist.size)
+            chunk.count = values.size
+            chunk.mean = float(values.mean(dtype=numpy.float64))
+            chunk.minimum = float(values.min())
+            chunk.maximum = float(values.max())
+            deviation = values.astype(numpy.float64)
+            deviation -= chunk.mean
+            chunk.m2 = float(numpy.dot(deviation, deviation))
+            del deviation
+            if self.hist.size:
+                #Out of range values are counted in the end bins, the exact extrema are kept above
+                numpy.clip(values, self.lower, self.upper, out=values)
+                chunk.hist, edges = numpy.histogram(values, self.hist.size, range=(self.lower, self.upper))
+            self.merge(chunk)
+    
+    def merge(self, other):
+        '''Combine the statistics of another RunningStats into this one.'''
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / float(count)
+        self.m2 += other.m2 + delta * delta * self.count * other.count / float(count)
+        self.count = count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        if self.hist.size:
+            self.hist += other.hist
+        return self
+    
+    def std(self):
+        '''The population standard deviation, as numpy.std'''
+        if self.count == 0:
+            return 0.0
+        return (self.m2 / self.count) ** 0.5
+    
+    def percentile(self, p):
+        '''
+        Estimate the pth percentile from the histogram, interpolating linearly 
+        within the bin.  The error is at most one bin width.
+        '''
+        cdf = self.hist.cumsum()
+        target = p / 100.0 * cdf[-1]
+        index = min(int(numpy.searchsorted(cdf, target)), self.hist.size - 1)
+        below = cdf[index - 1] if index > 0 else 0
+        width = (self.upper - self.lower) / float(self.hist.size)
+        fraction = (target - below) / float(self.hist[index]) if self.hist[index] else 0.0
+        value = self.lower + (index + fraction) * width
+        return float(min(max(value, self.minimum), self.maximum))
+
+
+def histogram_range(band):
+    '''
+    Get the fixed histogram binning for a band as (lower, upper, num_bins).
+    
+    8 and 16-bit data get one bin per possible value so percentiles are exact.  
+    Other types are binned over the approximate band range, which GDAL 
+    computes cheaply from overviews or a subsample.
+    '''
+    dtype = band_datatype(band)
+    if dtype == 's8':
+        return (-128.5, 127.5, 256)
+    elif dtype == 'Byte':
+        return (-0.5, 255.5, 256)
+    elif dtype == 'UInt16':
+        return (-0.5, 65535.5, 65536)
+    elif dtype == 'Int16':
+        return (-32768.5, 32767.5, 65536)
+    else:
+        minimum, maximum = band.ComputeRasterMinMax(True)
+        if maximum <= minimum:
+            maximum = minimum + 1
+        return (float(minimum), float(maximum), 65536)
+
+
+def partial_stats(shared_array, i, args):
+    '''
+    Worker function which returns the RunningStats of a slice of the shared array.
+    The histogram binning is passed in args.histogram_range.  No data is left 
+    out, see valid_values.
+    '''
+    arr = valid_values(shared_array, i, args)
+    running = RunningStats(*args.histogram_range)
+    running.update(arr)
+    return running
+
+
+def valid_values(shared_array, i, args):
+    '''
+    The values of the rows i of a shared array without no data: the pixels
+    which are not valid in its no data mask if args.masked, see NoData, or
+    else those equal to any no data value in args.nodata.  NaN is left for
+    RunningStats to skip.
+    '''
+    arr = shared_array.asarray()[i]
+    if getattr(args, 'masked', False):
+        return arr[NoData.valid(shared_array, i)]
+    ndv = getattr(args, 'nodata', None)
+    if ndv != None:
+        return arr[arr != ndv]
+    return arr
+
+
+def get_streaming_band_stats(band, segments, pipeline, args):
+    '''
+    Calculate the statistics of a band in a single pass over every segment.
+    
+    Segments are read through the pipeline and split across the workers, who 
+    each return a RunningStats which are merged here.  The band percentiles 
+    used by --clip are estimated from the merged histogram, so they are global
+    and the band is never held in memory or sorted.
+    
+    Returns a dictionary with bandmin, bandmax, bandmean, bandstd, ndv_band and,
+    if clipping, lowerbound and upperbound in the units of the band.
+    '''
+    total = stream_band(band, segments, pipeline, args)
+    return running_band_stats(total, band.GetNoDataValue(), args.clip)
+
+
+def stream_band(band, segments, pipeline, args):
+    '''
+    The streaming pass of get_streaming_band_stats.  Returns the merged 
+    RunningStats of the band, with its histogram, e.g. to be cached.
+    '''
+    ndv = band.GetNoDataValue()
+    if ndv == None:
+        ndv = args.ndv
+    args.histogram_range = histogram_range(band)
+    args.nodata = ndv
+    total = RunningStats(*args.histogram_range)
+    
+    def read(chunk, slot):
+        #Read straight into the shared buffer, GDAL converts to the type of the buffer
+        (xstart, ystart, intervalx, intervaly) = chunk
+        shared_arr = pipeline.pool.buffers[slot]
+        shared_arr.reshape((intervaly, intervalx))
+        array = shared_arr.asarray()
+        band.ReadAsArray(xstart, ystart, intervalx, intervaly, buf_obj=array)
+        return signed_bytes(band, array)
+    
+    def compute(chunk, array, slot):
+        for partial in pipeline.pool.map(partial_stats, slot, args):
+            total.merge(partial)
+    
+    pipeline.run(segments, read, compute)
+    return total
+
+
+def running_band_stats(total, ndv_band, clip=0):
+    '''
+    The band statistics dictionary, as get_streaming_band_stats, of a 
+    RunningStats.
+    '''
+    stats = {'bandmin' : total.minimum,
+             'bandmax' : total.maximum,
+             'bandmean' : total.mean,
+             'bandstd' : total.std(),
+             'ndv_band' : ndv_band
+             }
+    if clip > 0 and clip < 100:
+        stats['lowerbound'] = total.percentile(clip)
+        stats['upperbound'] = total.percentile(100 - clip)
+    return stats
+
+
+def partial_below(shared_array, i, args):
+    '''
+    Worker function which returns the number of valid pixels in a slice of the
+    shared array, their sum, the sum of their squared deviations from 
+    args.center and the number below each of args.thresholds.  args.nodata is
+    as partial_stats.
+    '''
+    arr = valid_values(shared_array, i, args)
+    valid = arr[numpy.isfinite(arr)]
+    below = [int(numpy.count_nonzero(valid < threshold)) for threshold in args.thresholds]
+    deviation = valid.astype(numpy.float64) - args.center
+    return valid.size, float(valid.sum(dtype=numpy.float64)), float(numpy.dot(deviation, deviation)), below
+
+
+def get_approx_band_stats(band, windows, pipeline, args, z=1.96):
+    '''
+    Estimate the statistics of a band from a sample of windows, e.g. from
+    Segment.sample_blocks, with a streaming pass over only those windows.
+
+    The sampling error is estimated between windows.  The standard error of
+    the mean is that of the window means, that of the standard deviation is
+    the jackknife estimate leaving out a window at a time.  For the percentiles the fraction
+    of each window below the estimate is used the same way and the confidence
+    interval of the fraction is mapped back through the sample histogram 
+    (Woodruff's method).  Pixels within a window are not independent, so this
+    is much wider, and more honest, than treating them as a random sample.
+
+    Returns a dictionary as get_streaming_band_stats, plus the half width of
+    the z (95%) confidence interval of the mean, the standard deviation and, 
+    if clipping, of the bounds as bandmean_error, bandstd_error, 
+    lowerbound_error and upperbound_error, and the number of pixels sampled as
+    sample_count.  With fewer than two windows the errors are infinite.
+    '''
+    total = stream_band(band, windows, pipeline, args)
+    stats = running_band_stats(total, band.GetNoDataValue(), args.clip)
+    stats['sample_count'] = total.count
+
+    keys = [key for key in ('lowerbound', 'upperbound') if key in stats]
+    ndv = band.GetNoDataValue()
+    if ndv == None:
+        ndv = args.ndv
+    settings = argparse.Namespace(thresholds=[stats[key] for key in keys], nodata=ndv, center=stats['bandmean'])
+    counts = []
+    sums = []
+    squares = []
+    below = []
+
+    def read(chunk, slot):
+        (xstart, ystart, intervalx, intervaly) = chunk
+        shared_arr = pipeline.pool.buffers[slot]
+        shared_arr.reshape((intervaly, intervalx))
+        array = shared_arr.asarray()
+        band.ReadAsArray(xstart, ystart, intervalx, intervaly, buf_obj=array)
+        return signed_bytes(band, array)
+
+    def compute(chunk, array, slot):
+        count = 0
+        subtotal = 0.0
+        square = 0.0
+        under = numpy.zeros(len(keys))
+        for partial in pipeline.pool.map(partial_below, slot, settings):
+            count += partial[0]
+            subtotal += partial[1]
+            square += partial[2]
+            under += partial[3]
+        if count > 0:
+            counts.append(count)
+            sums.append(subtotal)
+            squares.append(square)
+            below.append(under)
+
+    pipeline.run(windows, read, compute)
+
+    counts = numpy.array(counts, dtype=numpy.float64)
+    m = counts.size
+    if m < 2:
+        #One window, the error can not be estimated
+        stats['bandmean_error'] = numpy.inf
+        stats['bandstd_error'] = numpy.inf
+        for key in keys:
+            stats[key + '_error'] = numpy.inf
+        return stats
+
+    weights = counts / counts.sum()
+    means = numpy.array(sums) / counts
+    mean = numpy.dot(weights, means)
+    stats['bandmean_error'] = z * numpy.sqrt(m / (m - 1.0) * numpy.dot(weights ** 2, (means - mean) ** 2))
+
+    #The standard deviation of the sample without each window in turn, from the deviations about the center
+    sums = numpy.array(sums)
+    squares = numpy.array(squares)
+    rest = counts.sum() - counts
+    shift = (sums.sum() - sums) / rest - settings.center
+    stds = numpy.sqrt(numpy.maximum((squares.sum() - squares) / rest - shift ** 2, 0))
+    stats['bandstd_error'] = z * numpy.sqrt((m - 1.0) / m * ((stds - stds.mean()) ** 2).sum())
+
+    fractions = numpy.array(below).reshape(m, len(keys)) / counts[:, None]
+    for k, key in enumerate(keys):
+        fraction = numpy.dot(weights, fractions[:, k])
+        se = numpy.sqrt(m / (m - 1.0) * numpy.dot(weights ** 2, (fractions[:, k] - fraction) ** 2))
+        low = total.percentile(100 * max(fraction - z * se, 0))
+        high = total.percentile(100 * min(fraction + z * se, 1))
+        stats[key + '_error'] = (high - low) / 2.0
+    return stats
+
+
+def get_streaming_stats(pipeline, segments, read, prepare, clip=0):
+    '''
+    Calculate the statistics of derived data, e.g. the output of earlier steps
+    of a chain, in a streaming pass over every segment.
+
+    read(chunk, slot) is as for Pipeline.run.  prepare(chunk, array, slot) is
+    given each segment as read and returns the array to be measured and a 
+    bool array of its valid pixels, or None if they all are.  The range of derived data is not known in advance, so if 
+    clipping a second pass fills a histogram over the range found by the first.
+
+    Returns a dictionary with bandmin, bandmax, bandmean, bandstd and, if
+    clipping, lowerbound and upperbound.
+    '''
+    total = RunningStats()
+
+    def compute(chunk, array, slot):
+        total.update(*prepare(chunk, array, slot))
+
+    pipeline.run(segments, read, compute)
+    stats = {'bandmin' : total.minimum,
+             'bandmax' : total.maximum,
+             'bandmean' : total.mean,
+             'bandstd' : total.std()
+             }
+
+    if clip > 0 and clip < 100:
+        upper = total.maximum if total.maximum > total.minimum else total.minimum + 1
+        histogram = RunningStats(total.minimum, upper, 65536)
+
+        def compute(chunk, array, slot):
+            histogram.update(*prepare(chunk, array, slot))
+
+        pipeline.run(segments, read, compute)
+        stats['lowerbound'] = histogram.percentile(clip)
+        stats['upperbound'] = histogram.percentile(100 - clip)
+    return stats
+
+def get_shared_stats(pool, slot, clip=0, masked=False):
+    '''
+    Calculate the statistics of the array in a shared buffer of the pool, split
+    across the workers.  NaN and, if masked, the pixels which are not valid in
+    the no data mask of the buffer, see NoData, are skipped.  If clipping a 
+    second pass fills a histogram over the range found by the first.
+
+    Returns a dictionary with bandmin, bandmax, bandmean, bandstd, the count
+    of pixels and, if clipping, lowerbound and upperbound.  A buffer with no 
+    valid pixels has a count of 0 and no percentiles.
+    '''
+    settings = argparse.Namespace(histogram_range=(None, None, 0), masked=masked)
+    total = RunningStats()
+    for partial in pool.map(partial_stats, slot, settings):
+        total.merge(partial)
+    stats = {'bandmin' : total.minimum,
+             'bandmax' : total.maximum,
+             'bandmean' : total.mean,
+             'bandstd' : total.std(),
+             'count' : total.count
+             }
+
+    if clip > 0 and clip < 100 and total.count > 0:
+        upper = total.maximum if total.maximum > total.minimum else total.minimum + 1
+        settings.histogram_range = (total.minimum, upper, 65536)
+        histogram = RunningStats(*settings.histogram_range)
+        for partial in pool.map(partial_stats, slot, settings):
+            histogram.merge(partial)
+        stats['lowerbound'] = histogram.percentile(clip)
+        stats['upperbound'] = histogram.percentile(100 - clip)
+    return stats
+
+def tile_grid(xsize, ysize, tiles):
+    '''
+    The grid of the adaptive histogram equalization over a band of xsize by
+    ysize pixels, tiles tiles across and down, as (tile rows, tile columns,
+    tiles down, tiles across).  Edge tiles may be smaller.
+    '''
+    tiley = max(-(-ysize // tiles), 1)
+    tilex = max(-(-xsize // tiles), 1)
+    return tiley, tilex, -(-ysize // tiley), -(-xsize // tilex)
+
+def partial_tiles(shared_array, i, args):
+    '''
+    Worker function which returns the histograms of the tiles, see tile_grid,
+    under the rows i of a segment in the shared array, without its halo.  
+    args.tile_grid is the grid, args.num_bins the number of bins over 
+    args.value_range, args.chunk the segment and args.window the window read
+    for it.  The pixels which are not valid, if args.masked, and NaN are left
+    out.
+
+    Returns the first tile row and the histograms of the tile rows from it,
+    as an array of (tile rows, tiles across, bins).
+    '''
+    arr = shared_array.asarray()
+    (xstart, ystart, intervalx, intervaly) = args.chunk
+    (readx, ready, readcolumns, readrows) = args.window
+    tiley, tilex, tilesdown, tilesacross = args.tile_grid
+    bins = args.num_bins
+    low, high = args.value_range
+    if high <= low:
+        high = low + 1
+
+    #Rows of the slice within the segment, image coordinates of its pixels
+    start, stop, step = i.indices(arr.shape[0])
+    first = max(start, ystart - ready)
+    last = min(stop, ystart - ready + intervaly)
+    if last <= first:
+        return 0, numpy.zeros((0, tilesacross, bins), dtype=numpy.int64)
+    columns = slice(xstart - readx, xstart - readx + intervalx)
+    tilecolumn = (xstart + numpy.arange(intervalx)) // tilex
+    top = (ready + first) // tiley
+    tilerows = (ready + last - 1) // tiley - top + 1
+    hist = numpy.zeros(tilerows * tilesacross * bins, dtype=numpy.int64)
+
+    #A block of rows at a time, to bound the temporary index arrays
+    rows = max(RunningStats.blocksize // max(intervalx, 1), 1)
+    for blockstart in xrange(first, last, rows):
+        block = slice(blockstart, min(blockstart + rows, last))
+        values = arr[block, columns]
+        valid = numpy.isfinite(values)
+        if args.masked:
+            valid &= NoData.valid(shared_array, block)[:, columns]
+        tilerow = (ready + numpy.arange(block.start, block.stop)) // tiley - top
+        tile = tilerow[:, None] * tilesacross + tilecolumn[None, :]
+        level = numpy.clip((values[valid] - low) * (bins / float(high - low)), 0, bins - 1).astype(numpy.intp)
+        hist += numpy.bincount(tile[valid] * bins + level, minlength=hist.size)
+    return top, hist.reshape(tilerows, tilesacross, bins)
+
+def tile_histograms(pool, slot, chunk, window, masked, args):
+    '''
+    The histograms of the tiles, see partial_tiles, of the segment chunk in a
+    shared buffer of the pool, split across the workers.  Returns an array of
+    (tiles down, tiles across, bins) which is zero outside the segment.
+    '''
+    tiley, tilex, tilesdown, tilesacross = args.tile_grid
+    settings = argparse.Namespace(tile_grid=args.tile_grid,
+                                  num_bins=args.num_bins,
+                                  value_range=(args.bandmin, args.bandmax),
+                                  chunk=chunk,
+                                  window=window,
+                                  masked=masked)
+    hist = numpy.zeros((tilesdown, tilesacross, args.num_bins), dtype=numpy.int64)
+    for top, partial in pool.map(partial_tiles, slot, settings):
+        hist[top:top + partial.shape[0]] += partial
+    return hist
+
+def tile_cdfs(hist, clip_limit):
+    '''
+    The mappings of the adaptive histogram equalization from the histograms
+    of the tiles.  The histogram of each tile is clipped at clip_limit times
+    its mean bin count, which limits the contrast, and what is clipped is 
+    spread evenly over every bin.  No limit is set if clip_limit is 0.
+
+    Returns the cumulative histograms scaled to [0, 1] as float32.  Tiles
+    with no valid pixels are left unchanged by their mapping.
+    '''
+    hist = hist.astype(numpy.float64)
+    bins = hist.shape[-1]
+    counts = hist.sum(axis=-1, keepdims=True)
+    if clip_limit > 0:
+        limit = numpy.maximum(clip_limit * counts / bins, 1.0)
+        excess = numpy.maximum(hist - limit, 0).sum(axis=-1, keepdims=True)
+        hist = numpy.minimum(hist, limit) + excess / bins
+    cdf = hist.cumsum(axis=-1)
+    identity = numpy.arange(1, bins + 1, dtype=numpy.float64) / bins
+    cdf = numpy.where(counts > 0, cdf / numpy.maximum(cdf[..., -1:], 1e-12), identity)
+    return cdf.astype(numpy.float32)
+
+def get_tile_cdfs(pipeline, segments, read, ready, window, args):
+    '''
+    Calculate the mappings of the adaptive histogram equalization, see 
+    tile_cdfs, in a streaming pass over every segment.  The tiles are on a 
+    fixed grid over the whole band, args.tile_grid, so the mappings do not 
+    depend on the segmentation.
+
+    read(chunk, slot) is as for Pipeline.run.  ready(chunk, slot) readies the
+    segment in its buffer, e.g. marks the no data and applies any steps 
+    before, and returns True if it has no data, see Steps.mask_nodata.  
+    window(chunk) is the window read for a segment.  The histograms are over
+    the band range, args.bandmin to args.bandmax, in args.num_bins bins.
+    '''
+    tiley, tilex, tilesdown, tilesacross = args.tile_grid
+    total = numpy.zeros((tilesdown, tilesacross, args.num_bins), dtype=numpy.int64)
+
+    def compute(chunk, array, slot):
+        masked = ready(chunk, slot)
+        total[...] += tile_histograms(pipeline.pool, slot, chunk, window(chunk), masked, args)
+
+    pipeline.run(segments, read, compute)
+    return tile_cdfs(total, args.clip_limit)
+
 def gethist_cdf(array,num_bins):
     '''
     This function calculates the cumulative distribution function of a given array and requires that both the input array and the number of bins be provided.
@@ -165,12 +713,12 @@ def normalize(array, bandmin, bandmax, dtype):
     Returns a normalized array
     '''
     
-    if dtype == 'Float32':
-        pass
+    coefficients = normalization(bandmin, bandmax, dtype)
     #If the data type is unsigned, normalize to between 0 and 1
-    else:
-        array -= bandmin
-        array *= 1/(bandmax-bandmin)   
+    if coefficients is not None:
+        offset, factor = coefficients
+        array -= offset
+        array *= factor
 
     #If the data type is signed, normalize to between -1 and 1
     #datarange = 2 / (bandmax - bandmin)
@@ -178,6 +726,24 @@ def normalize(array, bandmin, bandmax, dtype):
     #array = (array - ((bandmax-bandmin)/2))/((bandmax-bandmin)/2)
     return array
 
+def span(low, high):
+    '''
+    The width of the range low to high, or 1 if it is empty, e.g. the range 
+    of a uniform tile, so that it can always be divided by.
+    '''
+    if high == low:
+        return 1.0
+    return high - low
+
+def normalization(bandmin, bandmax, dtype):
+    '''
+    The coefficients of normalize, y = (x - offset) * factor, as (offset,
+    factor), or None for float data which is not normalized.
+    '''
+    if dtype in _float_types:
+        return None
+    return bandmin, 1.0/span(bandmin, bandmax)
+
 def scale(array, args):
     '''
     This function is used to scale the data between a user defined range [c,d].  By default this range is between 1 and 255.  This maintains 0 as a special no data value should the user wish to set it.
@@ -188,6 +754,17 @@ def scale(array, args):
         
     Returns a scaled ndarray
     '''
+    factor, offset, scalemin, scalemax = scaling(args)
+    array *= factor
+    array += offset
+    numpy.clip(array, scalemin, scalemax, out=array)
+    return array
+
+def scaling(args):
+    '''
+    The coefficients of scale, y = factor * x + offset clamped to [scalemin,
+    scalemax], as (factor, offset, scalemin, scalemax).
+    '''
     if args.scale == None:
         scalemin = 1.0
         scalemax = 255.0
@@ -196,25 +773,22 @@ def scale(array, args):
         scalemax = float(args.scale[1])
     #Unpack the scalemin and scalemax variables if they exist
     #array = ((array-args.bandmin)*(scalemax-scalemin)/(args.bandmax-args.bandmin))+scalemin
-    array -= args.bandmin
-    array *= (scalemax-scalemin)
-    array *= 1/(args.bandmax-args.bandmin)
-    array += scalemin
-    low_value_index = array < scalemin
-    array[low_value_index] = scalemin
-    high_value_index =  array > scalemax 
-    array[high_value_index] =  scalemax
-    return array
+    factor = (scalemax-scalemin) * (1.0/span(args.bandmin, args.bandmax))
+    offset = scalemin - args.bandmin * factor
+    return factor, offset, scalemin, scalemax
 
-def setnodata(shared_arr, ndv):
+def setnodata(shared_arr, ndv, valid=None):
     '''
-    This function sets the numpy nan, presumed to be a masked no data value to either the input datasets no data value or a user specified no data value.
+    This function sets the numpy nan, and the pixels which are not valid if a bool array valid is given, to either the input datasets no data value or a user specified no data value.
     
     Returns an ndarray with NaN replaced with the defined no data value.
     '''
     if ndv != None:
         arr = shared_arr.asarray()
-        arr = numpy.nan_to_num(ndv)
+        invalid = ~numpy.isfinite(arr)
+        if valid is not None:
+            invalid |= ~valid
+        arr[invalid] = ndv
         return arr
     else:
         pass
@@ -0,0 +1,373 @@
+"""
+Steps chains several stretches and filters into a single pass.  Each segment
+is read once, passes through every step in the shared buffer and is written
+once.
+
+A chain is given on the command line with repeated --step flags:
+
+    --step median_filter:kernel_size=5 --step linear_stretch:clip=2 --step gamma_stretch
+
+or as a JSON recipe, a list of objects naming the stretch and its options:
+
+    [{"stretch": "median_filter", "kernel_size": 5},
+     {"stretch": "linear_stretch", "clip": 2},
+     {"stretch": "gamma_stretch", "gammavalue": 1.6}]
+
+Step names are the keys of OptParse.stretches and the options are any other
+setting by its dest, e.g. clip, sigma or kernel_size.  Options not given for a
+step are taken from the command line.
+
+Every step has its own copy of the arguments, holding its own statistics.  A
+stretch after the first step needs the statistics of the output of the steps
+before it, which are computed in a streaming pass before the band is stretched.
+"""
+import argparse
+import ast
+import copy
+import json
+
+import numpy
+
+from pystretch.core import Lookup, NoData, OptParse, Stats, Timer
+from pystretch.filter import Filter
+
+#Types which float32, with a 24 bit significand, would round
+_wide_types = ['Int32', 'UInt32', 'Float64']
+
+#The pixels a worker takes through every operation of a fused step at once, see fused
+_block_pixels = 65536
+
+
+def parse_step(spec):
+    '''
+    Split a --step spec, name:key=value,key=value, into the name and a
+    dictionary of options.  Values are read as Python literals where possible.
+    '''
+    name, sep, options = spec.partition(':')
+    settings = {}
+    for option in options.split(','):
+        if not option:
+            continue
+        key, sep, value = option.partition('=')
+        try:
+            value = ast.literal_eval(value.strip())
+        except (ValueError, SyntaxError):
+            value = value.strip()
+        settings[key.strip()] = value
+    return name.strip(), settings
+
+
+def load_recipe(recipe):
+    '''Read a JSON recipe into a list of (name, options) pairs.'''
+    with open(recipe) as f:
+        steps = json.load(f)
+    chain = []
+    for step in steps:
+        step = dict((str(key), value) for key, value in step.iteritems())
+        chain.append((str(step.pop('stretch')), step))
+    return chain
+
+
+def get_steps(args):
+    '''
+    Returns the chain as a list of (stretch, stepargs).  Without --step or
+    --recipe the chain is the single stretch selected by the flags, with args
+    itself as its arguments.
+    '''
+    if args.recipe != None:
+        chain = load_recipe(args.recipe)
+    elif args.steps:
+        chain = [parse_step(spec) for spec in args.steps]
+    else:
+        return [(OptParse.get_stretch(args), args)]
+    return build_steps(args, chain)
+
+
+def build_steps(args, chain):
+    '''
+    Returns a chain of (name, options) pairs as a list of (stretch, stepargs),
+    each step with its own copy of args.
+    '''
+    steps = []
+    for name, settings in chain:
+        if name not in OptParse.stretches:
+            raise ValueError("Unknown step %s, choose from %s" %(name, ', '.join(sorted(OptParse.stretches))))
+        stepargs = copy.deepcopy(args)
+        #Only this step's flag is set, denorm and others check the flags
+        for flag in OptParse.stretches:
+            setattr(stepargs, flag, False)
+        setattr(stepargs, name, True)
+        for key, value in settings.iteritems():
+            setattr(stepargs, key, value)
+        steps.append((OptParse.stretches[name], stepargs))
+    return steps
+
+
+def copy_steps(steps):
+    '''A copy of the chain, so that each band can hold its own statistics.'''
+    return [(stretch, copy.deepcopy(stepargs)) for stretch, stepargs in steps]
+
+
+def working_type(steps, datatypes):
+    '''
+    The narrowest safe numpy type of the shared buffers for a chain over bands
+    of the type names datatypes, see Stats.band_datatype:
+
+        - the native type if every band is stretched with a lookup table, the
+          buffers then only hold the native data, read for the statistics 
+          and the lookup
+        - float64 for Float64 and 32-bit integer data
+        - float32 otherwise
+    '''
+    stretch, stepargs = steps[0]
+    if len(steps) == 1 and len(set(datatypes)) == 1 and Lookup.supported(stretch, datatypes[0], stepargs):
+        return numpy.dtype(Stats.datatype(datatypes[0]))
+    if any([datatype in _wide_types for datatype in datatypes]):
+        return numpy.dtype(numpy.float64)
+    return numpy.dtype(numpy.float32)
+
+
+def needs_stats(stretch):
+    '''Stretches are normalized by the band statistics, filters are not.'''
+    return 'stretch' in stretch.__name__
+
+
+def set_band_stats(stepargs, bandstats, stretch, dtype):
+    '''
+    Set the band statistics of a step.  Percentile bounds, and the range of
+    the tile histograms of an adaptive equalization, are converted to the
+    normalized units the stretch sees.
+    '''
+    for key, value in bandstats.iteritems():
+        setattr(stepargs, key, value)
+    if 'lowerbound' in bandstats and stepargs.segment == False and needs_stats(stretch):
+        bounds = numpy.array([stepargs.lowerbound, stepargs.upperbound], dtype=numpy.float64)
+        stepargs.lowerbound, stepargs.upperbound = Stats.normalize(bounds, stepargs.bandmin, stepargs.bandmax, dtype)
+    if stepargs.clahe_stretch == True:
+        #The tile histograms are over the band range, see Stats.tile_histograms
+        bounds = numpy.array([stepargs.bandmin, stepargs.bandmax], dtype=numpy.float64)
+        stepargs.tile_range = tuple(Stats.normalize(bounds, stepargs.bandmin, stepargs.bandmax, dtype))
+
+
+def load(pool, slot, array, ndv, fill):
+    '''
+    Copy a segment into the shared buffer pool.buffers[slot] and mark its no
+    data, see mask_nodata.
+    '''
+    pool.buffers[slot].load(array)
+    return mask_nodata(pool, slot, ndv, fill)
+
+
+def mask_nodata(pool, slot, ndv, fill):
+    '''
+    Mark the no data pixels, those equal to ndv or NaN, of a segment already
+    in the shared buffer pool.buffers[slot], e.g. read into it directly, in
+    the no data mask of the buffer, see NoData.  They are set to NaN if fill.
+
+    Returns True if the segment has any no data, False if it has none or 
+    there is no ndv, in which case the mask is not used.
+    '''
+    return mask_many(pool, [(slot, ndv, fill)])[0]
+
+
+def mask_many(pool, items, tags=None):
+    '''
+    Mark the no data of several buffers at once, as mask_nodata, e.g. of 
+    every band of a segment.  items is a list of (slot, ndv, fill) and tags
+    as for apply_many.  Returns a list of the results of mask_nodata.
+    '''
+    if tags is None:
+        tags = [{}] * len(items)
+    tickets = []
+    for (slot, ndv, fill), tag in zip(items, tags):
+        if ndv == None:
+            tickets.append(None)
+            continue
+        settings = argparse.Namespace(ndv=ndv, fill=fill)
+        slices = NoData.slices(pool, pool.buffers[slot].shape[0])
+        tickets.append(pool.submit(NoData.mark, slot, settings, slices, tags=tag))
+    return [ticket is not None and sum(pool.wait(ticket)) > 0 for ticket in tickets]
+
+
+def apply(pool, slot, nodata, stretch, stepargs, dtype, last=False, ndv=None):
+    '''
+    Apply one step to the segment in pool.buffers[slot]: normalize, compute
+    any per segment statistics, stretch in the workers and denormalize.  The
+    last step of a chain also scales and sets the no data value, see 
+    apply_many.
+    '''
+    apply_many(pool, [(slot, nodata, stretch, stepargs)], dtype, last=last, ndvs=[ndv])
+
+
+def apply_many(pool, items, dtype, tags=None, last=False, ndvs=None):
+    '''
+    Apply a step to several buffers at once, e.g. to every band of a segment.  
+    items is a list of (slot, nodata, stretch, stepargs), nodata being the
+    result of mask_nodata for the buffer.  The work for every buffer is 
+    submitted to the pool before waiting on any of it, so the workers are 
+    kept busy across buffers.  tags is a list with the trace tags of each 
+    item, e.g. its band, see Timer.stage.
+
+    The point operations around the stretch, the normalization, the
+    denormalization and, for the last step, the scaling by stepargs.scale and
+    writing the output no data value of each item in ndvs, are fused into 
+    the worker tasks, see fused.  The parent only normalizes when the 
+    segment statistics are needed.
+    '''
+    if not items:
+        return
+    if tags is None:
+        tags = [{}] * len(items)
+    if ndvs is None:
+        ndvs = [None] * len(items)
+    fusedargs = []
+    for (slot, nodata, stretch, stepargs), tag, ndv in zip(items, tags, ndvs):
+        with Timer.stage('normalize', step=stretch.__name__, **tag):
+            normalization = prepare(pool.buffers[slot], nodata, stretch, stepargs, dtype)
+        fusedargs.append(point_ops(stretch, stepargs, dtype, normalization, last, ndv, nodata))
+
+    with Timer.stage('stretch', step=items[0][2].__name__):
+        tickets = [pool.submit(fused, slot, opargs, tags=dict(tag, step=stretch.__name__))
+                   for (slot, nodata, stretch, stepargs), opargs, tag in zip(items, fusedargs, tags)]
+        for ticket in tickets:
+            pool.wait(ticket)
+
+        #Filters read the rows around their own, so their output is copied back once every row is filtered
+        tickets = [pool.submit(finish, slot, opargs, tags=dict(tag, step=stretch.__name__))
+                   for (slot, nodata, stretch, stepargs), opargs, tag in zip(items, fusedargs, tags)
+                   if opargs.scratch]
+        for ticket in tickets:
+            pool.wait(ticket)
+
+
+def point_ops(stretch, stepargs, dtype, normalization=None, last=False, ndv=None, masked=False):
+    '''
+    The arguments of fused: the step, its normalization (offset, factor) 
+    still to be made, see prepare, and the affine y = factor * x + offset, 
+    clamped to [low, high] if they are not None, which is the denormalization
+    and, for the last step, scale.  After the last step, if ndv is not None,
+    the pixels which are not finite and, if masked, those which are not valid
+    in the no data mask, see NoData, are set to ndv in a single write.
+    '''
+    factor, offset, low, high = 1.0, 0.0, None, None
+    if stepargs.normalized == True:
+        denormalization = Stats.denormalization(dtype, stepargs)
+        if denormalization is not None:
+            factor = denormalization
+    if last and stepargs.scale != None:
+        scalefactor, offset, low, high = Stats.scaling(stepargs)
+        factor *= scalefactor
+    return argparse.Namespace(stretch=stretch,
+                              stepargs=stepargs,
+                              scratch=Filter.halo(stretch, stepargs) > 0,
+                              normalization=normalization,
+                              factor=factor,
+                              offset=offset,
+                              low=low,
+                              high=high,
+                              ndv=ndv if last else None,
+                              masked=masked)
+
+
+def fused(shared_array, i, args):
+    '''
+    Worker function applying a step and its point operations, see point_ops,
+    to the rows i.  The rows are taken through every operation a block of
+    about _block_pixels at a time, so each pixel is read from memory once
+    and stays in cache for the rest.  Filters read the rows around their own
+    and write a scratch array, so they are applied to all of i and finished
+    by finish once every row is filtered.
+    '''
+    if args.scratch:
+        args.stretch(shared_array, i, args.stepargs)
+        return
+    arr = shared_array.asarray()
+    start, stop, step = i.indices(arr.shape[0])
+    rows = max(_block_pixels // max(arr[0].size, 1), 1)
+    for first in xrange(start, stop, rows):
+        block = slice(first, min(first + rows, stop))
+        if args.normalization is not None:
+            offset, factor = args.normalization
+            arr[block] -= offset
+            arr[block] *= factor
+        args.stretch(shared_array, block, args.stepargs)
+        _affine(shared_array, block, args)
+
+
+def finish(shared_array, i, args):
+    '''
+    Worker function copying the filtered rows i back from the scratch array,
+    see Filter.copy_scratch, with the point operations of the step.
+    '''
+    arr = shared_array.asarray()
+    scratch = shared_array.scratch_asarray()
+    start, stop, step = i.indices(arr.shape[0])
+    rows = max(_block_pixels // max(arr[0].size, 1), 1)
+    for first in xrange(start, stop, rows):
+        block = slice(first, min(first + rows, stop))
+        arr[block] = scratch[block]
+        _affine(shared_array, block, args)
+
+
+def _affine(shared_array, block, args):
+    '''Apply the affine, clamp and no data value of point_ops to the rows block in place.'''
+    values = shared_array.asarray()[block]
+    if args.factor != 1.0:
+        values *= args.factor
+    if args.offset != 0.0:
+        values += args.offset
+    if args.low is not None:
+        numpy.clip(values, args.low, args.high, out=values)
+    if args.ndv is not None:
+        invalid = ~numpy.isfinite(values)
+        if args.masked:
+            invalid |= ~NoData.valid(shared_array, block)
+        values[invalid] = args.ndv
+
+
+def prepare(shared_arr, nodata, stretch, stepargs, dtype):
+    '''
+    Ready the segment in a shared buffer for a step: normalize and compute any
+    per segment statistics.  The normalization is left to the workers, see
+    fused, unless the statistics are of the normalized segment.
+
+    Returns the normalization (offset, factor) left to the workers, or None.
+    '''
+    data = shared_arr.asarray()
+    normalization = None
+    if needs_stats(stretch):
+        if stepargs.segment == True or stepargs.histequ_stretch == True:
+            Stats.normalize(data, stepargs.bandmin, stepargs.bandmax, dtype)
+        else:
+            normalization = Stats.normalization(stepargs.bandmin, stepargs.bandmax, dtype)
+        stepargs.normalized = True
+
+    #The segment statistics are of the valid pixels only
+    array = data
+    if nodata and (stepargs.segment == True or stepargs.histequ_stretch == True):
+        array = data[NoData.valid(shared_arr, slice(None))]
+        array = array[numpy.isfinite(array)]
+
+    if stepargs.clip > 0 and stepargs.segment == True:
+        stats = Stats.get_array_percentile(array, stepargs.clip)
+        stepargs.lowerbound = stats['lowerbound']
+        stepargs.upperbound = stats['upperbound']
+
+    #If the user wants to calc stats per segment:
+    if stepargs.segment == True:
+        stats = Stats.get_array_stats(array, stretch)
+        for key, value in stats.iteritems():
+            setattr(stepargs, key, value)
+    #Otherwise use the stats per band for each segment
+    else:
+        stepargs.mean = stepargs.bandmean
+        stepargs.maximum = stepargs.bandmax
+        stepargs.minimum = stepargs.bandmin
+        stepargs.standard_deviation = stepargs.bandstd
+
+    #Calculate the hist and cdf if we need it.  This way we do not calc it per core.
+    if stepargs.histequ_stretch == True:
+        cdf, bins = Stats.gethist_cdf(array, stepargs.num_bins)
+        stepargs.cdf = cdf
+        stepargs.bins = bins
+    return normalization
@@ -0,0 +1,241 @@
+"""
+Stretcher is the library interface to pystretch.  It stretches NumPy arrays in
+memory.  There is no GDAL dataset, command line or file involved:
+
+    import pystretch
+    stretched = pystretch.stretch(array, 'linear', clip=2, scale=(1, 255))
+
+A Stretcher holds the settings of a stretch, or chain, and can be applied to
+many arrays.  By default the statistics of each array are used, fit sets them
+once from a representative array instead, e.g. an overview of the image that
+tiles are cut from:
+
+    stretcher = pystretch.Stretcher([('median_filter', {'kernel_size' : 5}),
+                                     'linear_stretch'], clip=2, scale=(1, 255))
+    stretcher.fit(overview)
+    for tile in tiles:
+        result = stretcher(tile)
+
+Methods are the names in OptParse.stretches, the _stretch or _filter suffix can
+be left off.  Settings are those of the command line by their dest name, e.g.
+clip, sigma, kernel_size, scale or ndv.
+
+The work is split across a WorkerPool, or a ThreadPool with backend='threads'.
+Stretchers which are not given a pool share one per backend, started on first
+use and kept until the interpreter exits, so each array does not pay to start
+the workers.
+"""
+import atexit
+import copy
+import threading
+
+import numpy
+
+from pystretch.core import OptParse, Stats, Steps, WorkerPool
+from pystretch.filter import Filter
+
+#The data type names used to normalize and denormalize an array, by numpy type
+_numpy_to_gdal = {numpy.dtype(numpy.uint8) : 'Byte',
+                  numpy.dtype(numpy.int8) : 's8',
+                  numpy.dtype(numpy.uint16) : 'UInt16',
+                  numpy.dtype(numpy.int16) : 'Int16',
+                  numpy.dtype(numpy.uint32) : 'UInt32',
+                  numpy.dtype(numpy.int32) : 'Int32',
+                  numpy.dtype(numpy.float32) : 'Float32',
+                  numpy.dtype(numpy.float64) : 'Float64'}
+
+_pools = {}
+_lock = threading.Lock()
+_defaults = None
+
+
+def shared_pool(size, scratch=False, backend='processes', dtype=numpy.float32):
+    '''
+    The pool of a backend and buffer type shared by every Stretcher without
+    its own.  It is restarted, larger, if an array of size elements or a 
+    scratch array is needed which it does not have.  Call with the lock held.
+    '''
+    key = (backend, numpy.dtype(dtype))
+    pool = _pools.get(key)
+    if pool is None or pool.size < size or (scratch and pool.buffers[0].scratch is None):
+        if pool is not None:
+            size = max(size, pool.size)
+            scratch = scratch or pool.buffers[0].scratch is not None
+            pool.close()
+        pool = WorkerPool.backends[backend](size, dtype=dtype, scratch=scratch)
+        _pools[key] = pool
+    return pool
+
+
+def close():
+    '''Stop the workers of the shared pools.  They are started again if needed.'''
+    with _lock:
+        for key in _pools.keys():
+            _pools.pop(key).close()
+
+atexit.register(close)
+
+
+def resolve(method):
+    '''The name in OptParse.stretches of a method, e.g. linear_stretch for linear.'''
+    for name in (method, method + '_stretch', method + '_filter'):
+        if name in OptParse.stretches:
+            return name
+    raise ValueError("Unknown method %s, choose from %s" %(method, ', '.join(sorted(OptParse.stretches))))
+
+
+def settings():
+    '''A fresh copy of the default settings, see OptParse.defaults.'''
+    global _defaults
+    if _defaults is None:
+        _defaults = OptParse.defaults()
+        _defaults.normalized = False
+        #Arrays are stretched in the buffers, never with lookup tables
+        _defaults.lut = False
+    return copy.deepcopy(_defaults)
+
+
+class Stretcher(object):
+
+    def __init__(self, method, pool=None, **params):
+        """
+        method is a stretch name or a chain of them, a list of names or
+        (name, settings) pairs.  params are settings for every step, settings
+        given with a step take precedence.  pool is a WorkerPool to use in
+        place of the shared pool.
+        """
+        if isinstance(method, basestring):
+            method = [method]
+        chain = []
+        for step in method:
+            if isinstance(step, basestring):
+                step = (step, {})
+            name, stepsettings = step
+            chain.append((resolve(name), dict(stepsettings)))
+
+        args = settings()
+        for key, value in params.iteritems():
+            if not hasattr(args, key):
+                raise TypeError("Unknown setting %s" %key)
+            setattr(args, key, value)
+        self.args = args
+        self.steps = Steps.build_steps(args, chain)
+        self.scratch = any([Filter.halo(stretch, stepargs) > 0 for stretch, stepargs in self.steps])
+        self.stats = None
+        self.pool = pool
+        if pool is None:
+            self._lock = _lock
+        else:
+            self._lock = threading.Lock()
+
+    def __call__(self, array):
+        """
+        Stretch a 2-D array, or each band of a (bands, rows, columns) array.
+
+        Returns a new array of the same shape, float32 or float64 for float64 
+        and 32-bit integer arrays, see Steps.working_type.  No data pixels, 
+        those equal to the ndv setting, are left out of the statistics and are
+        ndv in the result.
+        """
+        array = numpy.asarray(array)
+        bands = self._bands(array)
+        if self.stats is not None and len(self.stats) != len(bands):
+            raise ValueError("The stretcher was fit to %i bands, not %i." %(len(self.stats), len(bands)))
+        working = self._working_type(array)
+        output = numpy.empty((len(bands),) + bands[0].shape, dtype=working)
+        with self._lock:
+            pool = self._get_pool(bands[0].size, working)
+            for b, band in enumerate(bands):
+                output[b] = self._stretch(pool, band, b)
+        if array.ndim == 2:
+            return output[0]
+        return output
+
+    def fit(self, array):
+        """
+        Calculate the statistics of each band of array and use them for every
+        array stretched, rather than the statistics of that array.
+
+        Returns the Stretcher.
+        """
+        array = numpy.asarray(array)
+        bands = self._bands(array)
+        stretch, stepargs = self.steps[0]
+        stats = []
+        with self._lock:
+            pool = self._get_pool(bands[0].size, self._working_type(array))
+            for band in bands:
+                nodata = Steps.load(pool, 0, band, self.args.ndv, self.scratch)
+                stats.append(Stats.get_shared_stats(pool, 0, stepargs.clip, nodata))
+        self.stats = stats
+        return self
+
+    def _bands(self, array):
+        '''Split an array into a list of 2-D bands.'''
+        array = numpy.asarray(array)
+        if array.ndim == 2:
+            return [array]
+        elif array.ndim == 3:
+            return list(array)
+        raise ValueError("Expected a 2-D or 3-D (bands, rows, columns) array, not %i-D." %array.ndim)
+
+    def _working_type(self, array):
+        '''The type arrays like array are stretched in.'''
+        return Steps.working_type(self.steps, [_numpy_to_gdal.get(array.dtype, 'Float32')])
+
+    def _get_pool(self, size, dtype):
+        '''The pool to stretch arrays of size elements of type dtype with.'''
+        if self.pool is None:
+            return shared_pool(size, self.scratch, self.args.backend, dtype)
+        if size > self.pool.size:
+            raise ValueError("An array of %i elements does not fit in the pool buffers of %i elements." %(size, self.pool.size))
+        return self.pool
+
+    def _stretch(self, pool, band, b):
+        '''Apply every step to a band in the first buffer of the pool.'''
+        dtype = self.args.dtype
+        if dtype == None:
+            dtype = _numpy_to_gdal.get(band.dtype, 'Float32')
+        ndv = self.args.ndv
+        shared_arr = pool.buffers[0]
+        nodata = Steps.load(pool, 0, band, ndv, self.scratch)
+
+        steps = Steps.copy_steps(self.steps)
+        bandstats = {}
+        for count, (stretch, stepargs) in enumerate(steps):
+            if count == 0:
+                if self.stats is not None:
+                    bandstats = self.stats[b]
+                else:
+                    bandstats = Stats.get_shared_stats(pool, 0, stepargs.clip, nodata)
+            elif Steps.needs_stats(stretch) and stepargs.segment == False:
+                #Later stretches see the output of the steps before them
+                bandstats = Stats.get_shared_stats(pool, 0, stepargs.clip, nodata)
+            if bandstats.get('count') == 0:
+                #Every pixel is no data, e.g. an empty tile, so there is nothing to stretch
+                if ndv != None:
+                    shared_arr.asarray()[...] = ndv
+                return shared_arr.asarray()
+            if 'lowerbound' not in bandstats:
+                #Without clipping a linear stretch runs from the minimum to the maximum
+                bandstats = dict(bandstats, lowerbound=bandstats['bandmin'], upperbound=bandstats['bandmax'])
+            Steps.set_band_stats(stepargs, bandstats, stretch, dtype)
+            if stepargs.clahe_stretch == True:
+                #The tiles are over the whole array, which is in the buffer
+                rows, columns = band.shape
+                whole = (0, 0, columns, rows)
+                stepargs.origin = (0, 0)
+                stepargs.tile_grid = Stats.tile_grid(columns, rows, stepargs.tiles)
+                hist = Stats.tile_histograms(pool, 0, whole, whole, nodata, stepargs)
+                stepargs.tile_cdfs = Stats.tile_cdfs(hist, stepargs.clip_limit)
+            Steps.apply(pool, 0, nodata, stretch, stepargs, dtype, last=count == len(steps) - 1, ndv=ndv)
+        return shared_arr.asarray()
+
+
+def stretch(array, method, **params):
+    '''
+    Stretch an array, see Stretcher.  For example:
+
+        stretch(array, 'standard_deviation', sigma=2.5)
+    '''
+    return Stretcher(method, **params)(array)
@@ -1,4 +1,35 @@
+"""
+Timer measures a run, from the total time down to each task of each worker.
+
+Stages are timed with stage, or timed for whole functions, and their totals are
+always kept.  Stages run at once in the pipeline threads and may be nested, 
+e.g. stretch within compute, so the totals overlap.  The time each worker 
+spends in each task, e.g. linear_stretch, is returned by the WorkerPool and 
+totalled by task.  The totals are written with write_stages.
+
+With tracing on, see start_trace, every stage and task is also recorded as an
+event with its start, duration and tags: the band, the segment, the worker
+and any other given.  Tags of a stage are inherited by the stages and tasks
+within it.  The trace is written to JSON or CSV with write_trace, so a slow
+run can be broken down to find whether it is I/O or compute bound.
+"""
+import csv
+import json
+import threading
 import time
+from contextlib import contextmanager
+
+#The seconds spent in each stage of a run and by the workers in each task, see stage and task
+stages = {}
+tasks = {}
+#The events of the trace, None unless tracing
+events = None
+_origin = time.time()
+_lock = threading.Lock()
+_local = threading.local()
+
+#The columns of a CSV trace
+_fields = ['stage', 'task', 'band', 'segment', 'step', 'worker', 'start', 'seconds']
 
 def starttimer():
     starttime = time.time()
@@ -15,4 +46,101 @@ def totaltime(starttime):
         totalseconds = int(totaltime % 60)
         if totalseconds < 10:
             totalseconds = str(0) + str(totalseconds)
-        print "Total time to process the image was " + str(totalminutes) + ':' + str(totalseconds) + '.'
\ No newline at end of file
+        print "Total time to process the image was " + str(totalminutes) + ':' + str(totalseconds) + '.'
+
+def reset():
+    '''Clear the stage times and any trace, at the start of a run.'''
+    global events, _origin
+    with _lock:
+        stages.clear()
+        tasks.clear()
+        events = None
+        _origin = time.time()
+
+def start_trace():
+    '''Record every stage and task as an event from now on.'''
+    global events
+    with _lock:
+        events = []
+
+def context():
+    '''The tags of the stages this thread is in.'''
+    return dict(getattr(_local, 'tags', {}))
+
+@contextmanager
+def stage(name, **tags):
+    '''
+    Add the time spent in a with block to the total of a stage and trace it
+    with tags, e.g. band=1.  Safe to use from several threads.
+    '''
+    outer = context()
+    tags = dict(outer, **tags)
+    _local.tags = tags
+    start = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.time() - start
+        _local.tags = outer
+        add(name, seconds)
+        record(dict(tags, stage=name, start=start - _origin, seconds=seconds))
+
+def add(name, seconds):
+    '''Add seconds to the total of a stage.'''
+    with _lock:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+def task(name, worker, start, seconds, **tags):
+    '''
+    Add the time a worker spent on a task, started at start (time.time()), to
+    the total of the task and trace it with the tags of the calling thread.
+    '''
+    with _lock:
+        tasks[name] = tasks.get(name, 0.0) + seconds
+    if events is not None:
+        record(dict(context(), stage='worker', task=name, worker=worker, start=start - _origin, seconds=seconds, **tags))
+
+def record(event):
+    '''Add an event to the trace, if tracing.'''
+    with _lock:
+        if events is not None:
+            events.append(event)
+
+def timed(name, func, tags=None):
+    '''
+    Wrap a function, e.g. a pipeline stage, so that every call is timed as a
+    stage.  tags, if given, is called with the arguments and returns the tags.
+    '''
+    def wrapper(*args, **kwargs):
+        with stage(name, **(tags(*args) if tags is not None else {})):
+            return func(*args, **kwargs)
+    return wrapper
+
+def write_stages(filename, starttime, pixels):
+    '''
+    Write the total time, the number of pixels processed, the time of each 
+    stage and of each worker task to a JSON file.
+    '''
+    with _lock:
+        timings = {'total' : time.time() - starttime,
+                   'pixels' : pixels,
+                   'stages' : dict(stages),
+                   'tasks' : dict(tasks)}
+    with open(filename, 'w') as f:
+        json.dump(timings, f, indent=2, sort_keys=True)
+
+def write_trace(filename):
+    '''
+    Write the trace, in start order, to a CSV file if filename ends in .csv 
+    and a JSON file otherwise.  Times are in seconds from the start of the run.
+    '''
+    with _lock:
+        trace = sorted(events or [], key=lambda event: event['start'])
+    if filename.lower().endswith('.csv'):
+        with open(filename, 'wb') as f:
+            writer = csv.DictWriter(f, _fields, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(trace)
+    else:
+        with open(filename, 'w') as f:
+            json.dump({'events' : trace, 'stages' : dict(stages), 'tasks' : dict(tasks)}, f, indent=1, sort_keys=True)
@@ -0,0 +1,196 @@
+"""
+WorkerPool provides a set of long lived worker processes for the stretches.
+
+The pool is started once per run.  Shared memory buffers are allocated before
+the workers are forked so every worker inherits them, the buffers are never
+passed again.  Work is sent over a queue as (stretch, buffer, shape, slice, args)
+tasks, so starting and tearing down processes is no longer paid per segment.
+
+The pool can be used from a script or library:
+
+    pool = WorkerPool(size)
+    pool.buffers[0].load(array)
+    pool.map(Linear.linear_stretch, 0, args)
+    pool.close()
+
+ThreadPool has the same interface with threads in place of processes.  Most of
+the work in the stretches and filters is done in NumPy and SciPy, which release
+the GIL, so threads run it in parallel without copying the data into shared
+memory or starting processes.
+
+Every task is timed in the worker and the time is handed to Timer.task along 
+with the result.  One worker can also be run under cProfile, see profile.
+"""
+import cProfile
+import multiprocessing
+import Queue
+import threading
+import time
+import traceback
+
+import numpy
+
+from pystretch.core import ArrayConvert, Timer
+
+
+def _worker(buffers, tasks, results, number=0, profile=None):
+    """
+    Loop in the child process, executing tasks until a None sentinel is 
+    received.  If profile is a file name the tasks are run under cProfile and
+    the statistics are written to it when the worker stops.
+    """
+    profiler = None
+    if profile is not None:
+        profiler = cProfile.Profile()
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        ticket, index, func, slot, shape, i, args = task
+        start = time.time()
+        try:
+            shared_array = buffers[slot]
+            shared_array.reshape(shape)
+            if profiler is not None:
+                result = profiler.runcall(func, shared_array, i, args)
+            else:
+                result = func(shared_array, i, args)
+            results.put((ticket, index, True, result, (number, start, time.time() - start)))
+        except Exception:
+            results.put((ticket, index, False, traceback.format_exc(), (number, start, time.time() - start)))
+    if profiler is not None:
+        profiler.dump_stats(profile)
+
+
+class WorkerPool(object):
+
+    def __init__(self, size, processes=None, buffers=1, dtype=numpy.float32, scratch=False, profile=None):
+        """
+        Create the shared buffers and start the workers.
+
+        size is the number of elements in the largest array to be processed,
+        processes defaults to twice the number of cores and buffers is the
+        number of shared arrays which can be in flight at once.  Set scratch
+        if neighbourhood filters will be run, see SharedMemBuffer.  If profile
+        is a file name the first worker is run under cProfile and writes its
+        statistics there when the pool is closed, see pstats.
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count() * 2
+        self.processes = processes
+        self.size = size
+        self.buffers = [ArrayConvert.SharedMemBuffer(size, dtype, scratch) for b in xrange(buffers)]
+
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._ticket = 0
+        self._pending = {}
+        self._workers = []
+        for p in xrange(processes):
+            worker = multiprocessing.Process(target=_worker, args=(self.buffers, self._tasks, self._results, p, profile if p == 0 else None))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def slices(self, rows):
+        """Split rows into one contiguous row slice per worker."""
+        step = max(rows // self.processes, 1)
+        return [slice(i, i+step) for i in xrange(0, rows, step)]
+
+    def map(self, func, slot, args, slices=None):
+        """
+        Apply func(shared_array, slice, args) to the buffer slot and block until
+        every slice is complete.
+
+        Returns the values returned by func, in slice order.  If any worker
+        raises, a RuntimeError with the worker traceback is raised here.
+        """
+        return self.wait(self.submit(func, slot, args, slices))
+
+    def submit(self, func, slot, args, slices=None, tags=None):
+        """
+        Queue func(shared_array, slice, args) for the buffer slot without 
+        waiting, so that work on several buffers, e.g. every band of a segment,
+        is spread over the workers together.  tags, e.g. the band, are added
+        to the trace of the tasks, see Timer.task.
+
+        Returns a ticket to pass to wait.
+        """
+        shape = self.buffers[slot].shape
+        if slices is None:
+            slices = self.slices(shape[0])
+        ticket = self._ticket
+        self._ticket += 1
+        self._pending[ticket] = {'name' : func.__name__,
+                                 'tags' : tags or {},
+                                 'results' : [None] * len(slices),
+                                 'remaining' : len(slices),
+                                 'errors' : []}
+        for index, i in enumerate(slices):
+            self._tasks.put((ticket, index, func, slot, shape, i, args))
+        return ticket
+
+    def wait(self, ticket):
+        """
+        Block until every slice of a submitted ticket is complete and return 
+        the results, as map.  Results of other tickets which arrive first are
+        kept for them.
+        """
+        while self._pending[ticket]['remaining'] > 0:
+            other, index, success, result, (worker, start, seconds) = self._results.get()
+            pending = self._pending[other]
+            Timer.task(pending['name'], worker, start, seconds, **pending['tags'])
+            if success:
+                pending['results'][index] = result
+            else:
+                pending['errors'].append(result)
+            pending['remaining'] -= 1
+
+        pending = self._pending.pop(ticket)
+        if pending['errors']:
+            raise RuntimeError("%s failed in a worker process:\n%s" %(pending['name'], pending['errors'][0]))
+        return pending['results']
+
+    def close(self):
+        """Stop the workers.  The pool can not be used after it is closed."""
+        for worker in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+
+class ThreadPool(WorkerPool):
+
+    def __init__(self, size, processes=None, buffers=1, dtype=numpy.float32, scratch=False, profile=None):
+        """
+        Create the buffers and start the worker threads, as WorkerPool.  
+        processes, the number of threads, defaults to the number of cores.
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.size = size
+        self.buffers = [ArrayConvert.ArrayBuffer(size, dtype, scratch) for b in xrange(buffers)]
+
+        self._tasks = Queue.Queue()
+        self._results = Queue.Queue()
+        self._ticket = 0
+        self._pending = {}
+        self._workers = []
+        for p in xrange(processes):
+            worker = threading.Thread(target=_worker, args=(self.buffers, self._tasks, self._results, p, profile if p == 0 else None))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+
+#The pool classes by the name of the backend
+backends = {'processes' : WorkerPool,
+            'threads' : ThreadPool}
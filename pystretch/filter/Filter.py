@@ -1,19 +1,63 @@
+"""
+Neighbourhood filters need the pixels surrounding the rows they are given.  Each
+filter reads its row slice plus a halo of rows above and below from the shared
+array and writes only its own rows to the scratch array of the shared buffer,
+so that no process reads rows another is writing.  The scratch array is copied
+back with copy_scratch, or Steps.finish, once every slice is filtered.
+"""
 import numpy
-from scipy import signal
 from scipy import ndimage
 
+from pystretch.filter import Convolve
+
+def halo(stretch, args):
+    '''
+    The number of pixels needed on each side of a tile for the filter to give 
+    the same result as it would on the whole image.  Zero for point stretches.
+    '''
+    name = stretch.__name__
+    if name in ['mean_filter', 'median_filter', 'conservative_filter']:
+        return args.kernel_size // 2
+    elif name in ['gaussian_filter', 'gaussian_hipass']:
+        #The gaussian kernel is truncated at 4 sigma, see Convolve.gaussian_kernel
+        return int(4.0 * args.kernel_size + 0.5)
+    elif name in ['hipass_filter_3x3', 'laplacian_filter']:
+        return 1
+    elif name == 'hipass_filter_5x5':
+        return 2
+    return 0
+
+def _halo_rows(arr, i, size):
+    '''
+    Returns the slice of rows i padded by size rows either side, clipped to the
+    array, and the slice of the padded rows which corresponds to i.
+    '''
+    start, stop, step = i.indices(arr.shape[0])
+    padstart = max(start - size, 0)
+    padstop = min(stop + size, arr.shape[0])
+    return slice(padstart, padstop), slice(start - padstart, stop - padstart)
+
+def copy_scratch(shared_array, i, args):
+    '''Copy the filtered rows from the scratch array back to the shared array.'''
+    arr = shared_array.asarray()
+    arr[i] = shared_array.scratch_asarray()[i]
+
 def conservative_filter(shared_array, i, args):
+    '''
+    Clamp each pixel to the range of its neighbours, the centre pixel excluded.
+    The neighbourhood minimum and maximum are computed for the whole slice at 
+    once with ndimage rank filters.
+    '''
     kernel_size = args.kernel_size
     arr = shared_array.asarray()
-    def _minormax(arr):
-        size = len(arr)
-        element = size / 2
-        if arr[element] > numpy.amax(arr):
-            arr[element] = numpy.amax(arr)
-        elif arr[element] < numpy.amin(arr):
-            arr[element] = numpy.amin(arr)
-        return arr[element] 
-    arr[i] = ndimage.generic_filter(arr[i], _minormax, size=kernel_size)
+    out = shared_array.scratch_asarray()
+    rows, keep = _halo_rows(arr, i, halo(conservative_filter, args))
+    footprint = numpy.ones((kernel_size, kernel_size), dtype=bool)
+    footprint[kernel_size // 2, kernel_size // 2] = False
+    neighbourhood_min = ndimage.minimum_filter(arr[rows], footprint=footprint)[keep]
+    neighbourhood_max = ndimage.maximum_filter(arr[rows], footprint=footprint)[keep]
+    numpy.maximum(arr[i], neighbourhood_min, out=out[i])
+    numpy.minimum(out[i], neighbourhood_max, out=out[i])
     
 def createkernel(size):
     size = (size, size)
@@ -23,38 +67,93 @@ def createkernel(size):
 def gaussian_filter(shared_array, i, args):
     kernel_size = args.kernel_size
     arr = shared_array.asarray()
-    arr[i] = ndimage.gaussian_filter(arr[i], kernel_size)
+    out = shared_array.scratch_asarray()
+    rows, keep = _halo_rows(arr, i, halo(gaussian_filter, args))
+    out[i] = Convolve.gaussian(arr[rows], kernel_size)[keep]
 
 def gaussian_hipass(shared_array, i, args):
     kernel_size = args.kernel_size
     arr = shared_array.asarray()
-    gaussian_filter = ndimage.gaussian_filter(arr[i], kernel_size)
-    arr[i] = arr[i] - gaussian_filter
+    out = shared_array.scratch_asarray()
+    rows, keep = _halo_rows(arr, i, halo(gaussian_hipass, args))
+    gaussian_filter = Convolve.gaussian(arr[rows], kernel_size)[keep]
+    out[i] = arr[i] - gaussian_filter
 
 def hipass_filter_3x3(shared_array, i, args):
     arr=shared_array.asarray()
+    out = shared_array.scratch_asarray()
+    rows, keep = _halo_rows(arr, i, 1)
     kernel = numpy.array([[-1,-1,-1],[-1,8,-1],[-1,-1,-1]])
-    arr[i] = ndimage.convolve(arr[i], kernel)    
+    out[i] = Convolve.convolve(arr[rows], kernel)[keep]
     
 def hipass_filter_5x5(shared_array, i, args):
     arr=shared_array.asarray()
+    out = shared_array.scratch_asarray()
+    rows, keep = _halo_rows(arr, i, 2)
     kernel = numpy.array([[-1,-1,-1, -1, -1],[-1, 1, 2, 2, -1],[-1,2,4,2,-1],[-1,1,2,1,-1],[-1,-1,-1, -1, -1]])
-    arr[i] = ndimage.convolve(arr[i], kernel)
+    out[i] = Convolve.convolve(arr[rows], kernel)[keep]
 
 def laplacian_filter(shared_array, i, args):
     arr = shared_array.asarray()
+    out = shared_array.scratch_asarray()
+    rows, keep = _halo_rows(arr, i, 1)
     laplacian = numpy.array([[0,1,0],[1,-4,1],[0,1,0]],numpy.float64) #Created once per processor, but overhead should be small.
-    arr[i] = ndimage.filters.correlate(arr[i], laplacian, mode='nearest')
-
+    out[i] = Convolve.correlate(arr[rows], laplacian, mode='nearest')[keep]
 
 def mean_filter(shared_array, i, args):
     kernel_size = args.kernel_size
     kernel = createkernel(kernel_size)
     kernel *= 1/float(kernel_size)
     arr = shared_array.asarray()
-    arr[i] = ndimage.filters.correlate(arr[i], kernel, mode='nearest')
-
+    out = shared_array.scratch_asarray()
+    rows, keep = _halo_rows(arr, i, halo(mean_filter, args))
+    out[i] = Convolve.correlate(arr[rows], kernel, mode='nearest')[keep]
     
+def _histogram_median(arr, size, levels):
+    '''
+    Median filter for integer valued data by threshold decomposition.  For each
+    level t the pixels below t are counted in every window with a box filter,
+    i.e. the cumulative histogram of the window, and the median is the last 
+    level at which fewer than half the window is below.  This is a full image 
+    box filter pass per level, so the cost grows with levels rather than with 
+    the kernel size, and it only pays off for a few levels and a large kernel.
+    arr must be non-negative integers below levels.
+    '''
+    rank = size * size // 2 + 1
+    median = numpy.zeros(arr.shape, dtype=numpy.float32)
+    found = numpy.zeros(arr.shape, dtype=bool)
+    count = numpy.empty(arr.shape, dtype=numpy.float32)
+    for t in xrange(1, levels + 1):
+        ndimage.uniform_filter((arr < t).astype(numpy.float32), size, output=count)
+        count *= size * size
+        newly = count > rank - 0.5
+        newly &= ~found
+        median[newly] = t - 1
+        found |= newly
+    return median
+
 def median_filter(shared_array, i, args):
+    '''
+    Median filter with a kernel_size square kernel.  Integer valued data with
+    fewer levels than about 2/3 of the kernel area, e.g. Byte data and a 21x21
+    or larger kernel, uses the threshold decomposition in _histogram_median.
+    Measured, a pass per level costs as much as ndimage.median_filter spends 
+    on 1 to 1.6 pixels of the kernel, so with more levels it is slower.  
+    Wider ranges, as most 16-bit data, always use ndimage.median_filter.
+    '''
+    kernel_size = args.kernel_size
     arr = shared_array.asarray()
-    arr[i] = signal.medfilt(arr[i], args.kernel_size)
+    out = shared_array.scratch_asarray()
+    rows, keep = _halo_rows(arr, i, halo(median_filter, args))
+    padded = arr[rows]
+
+    histogram = False
+    if numpy.isfinite(padded).all():
+        low = padded.min()
+        levels = int(padded.max() - low) + 1
+        histogram = (2 * kernel_size * kernel_size > 3 * levels and
+                     (numpy.floor(padded) == padded).all())
+    if histogram:
+        out[i] = _histogram_median(padded - low, kernel_size, levels)[keep] + low
+    else:
+        out[i] = ndimage.median_filter(padded, kernel_size)[keep]
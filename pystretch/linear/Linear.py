@@ -1,5 +1,7 @@
 import numpy
 
+from pystretch.core.Stats import span
+
 
 def linear_stretch(shared_array, i,args):
 
@@ -22,7 +24,7 @@ def linear_stretch(shared_array, i,args):
     #print (minimum, maximum, newmin, newmax)
     #arr[i] -= newmin
     #since the arr is already normalized, the maxium and minimum would be 1 and 0
-    arr[i] =(arr[i]-newmin)*((maximum - minimum)/(newmax - newmin))+minimum - args.reduction*(maximum - minimum)
+    arr[i] =(arr[i]-newmin)*((maximum - minimum)/span(newmin, newmax))+minimum - args.reduction*(maximum - minimum)
         
     low_value_index = arr[i] < minimum
     arr[i][low_value_index] = minimum
@@ -48,7 +50,7 @@ def standard_deviation_stretch(shared_array, i,args):
 
     arr[i] -= newmin
 
-    arr[i] *= 1.0/(newmax-newmin)
+    arr[i] *= 1.0/span(newmin, newmax)
 
     
 
@@ -70,7 +72,7 @@ def binary_stretch(shared_array, i, args):
 
     #Normalize the threshold value because we normalized our data
 
-    threshold = (threshold - args.bandmin)/(args.bandmax-args.bandmin)
+    threshold = (threshold - args.bandmin)/span(args.bandmin, args.bandmax)
 
     arr = shared_array.asarray()
 
@@ -88,7 +90,7 @@ def hicut_stretch(shared_array, i, args):
 
     threshold = args.cutvalue
 
-    threshold = (threshold - args.bandmin)/(args.bandmax-args.bandmin)
+    threshold = (threshold - args.bandmin)/span(args.bandmin, args.bandmax)
 
     arr = shared_array.asarray()
 
@@ -102,7 +104,7 @@ def lowcut_stretch(shared_array, i, args):
 
     threshold = args.cutvalue
 
-    threshold = (threshold - args.bandmin)/(args.bandmax-args.bandmin)
+    threshold = (threshold - args.bandmin)/span(args.bandmin, args.bandmax)
 
     arr = shared_array.asarray()
 
@@ -22,8 +22,148 @@ def segment_image(xsize, ysize, xsegment=1, ysegment=1):
             numberofcolumns = intervalx if x + (intervalx * 2) < xsize else xsize -x
             tple = (x,y,numberofcolumns, numberofrows)
             output.append(tple)    
+            #The remainder is part of the last segment, so the segments do not overlap
+            if x + numberofcolumns >= xsize:
+                break
+        if y + numberofrows >= ysize:
+            break
     return output
+
+
+def pixel_footprint(itemsize, buffers=3, scratch=False, working=4):
+    """Estimate the number of bytes held in memory per pixel of a segment.
+
+    Segments are read straight into the shared buffers, of the working type
+    (working bytes, float32 by default), and with filters each buffer has a 
+    scratch array of the same type.  Each buffer also has a no data mask of a
+    bit per pixel and the segment being stretched, if it is pixel interleaved
+    or stretched with a lookup table, the native read (itemsize)."""
+
+    shared = working * buffers
+    if scratch:
+        shared *= 2
+    masks = (buffers + 7) // 8
+    return shared + masks + itemsize
+
+
+def plan_segments(xsize, ysize, blocksize, memory_budget, footprint, halo=0):
+    """Function to segment the image into windows which are aligned to the 
+    native block layout of the dataset and which fit into a memory budget.
     
+    blocksize is (blockx, blocky) as returned by band.GetBlockSize().  The 
+    memory budget is in bytes and the footprint is the number of bytes needed
+    per pixel, see pixel_footprint.  Windows are as wide as possible, full 
+    rows of blocks are preferred, so that a stripped image is read in whole
+    strips.  Otherwise windows are about square, whole blocks high and, if
+    they fit, whole blocks wide.
 
+    Segments read with a halo, see add_halo, are planned so that the window 
+    read, the segment and halo pixels on each side, fits the budget.  A 
+    single block is the smallest segment returned, even if it exceeds the 
+    budget, unless only its halo does not fit.
     
+    Returns a list of (xstart, ystart, numberofcolumns, numberofrows) tuples."""
+
+    blockx, blocky = blocksize
+    blockx = min(blockx, xsize)
+    blocky = min(blocky, ysize)
+    pixels = memory_budget // footprint
+
+    #Full width windows have no halo at the sides, only above and below
+    rows = pixels // xsize - 2 * halo
+    if rows >= blocky:
+        intervalx = xsize
+        intervaly = min(rows // blocky * blocky, ysize)
+    else:
+        #Square windows waste the fewest pixels on the halo
+        side = int(numpy.sqrt(pixels)) - 2 * halo
+        intervaly = min(max(side // blocky, 1) * blocky, ysize)
+        columns = pixels // (intervaly + 2 * halo) - 2 * halo
+        if columns >= blockx:
+            intervalx = min(columns // blockx * blockx, xsize)
+        elif columns > 0 and blockx * blocky <= pixels:
+            #Only the halo does not fit, the block is read from the GDAL block cache
+            intervalx = columns
+        else:
+            intervalx = blockx
+
+    output = []
+    for y in xrange(0, ysize, intervaly):
+        numberofrows = min(intervaly, ysize - y)
+        for x in xrange(0, xsize, intervalx):
+            numberofcolumns = min(intervalx, xsize - x)
+            output.append((x, y, numberofcolumns, numberofrows))
+    return output
+
+
+def sample_blocks(xsize, ysize, blocksize, fraction, maxpixels=None, seed=0):
+    """Function to choose a stratified random sample of the native blocks of
+    an image, e.g. to estimate its statistics.  The blocks, in row major 
+    order, are split into equal strata and one block is drawn from each, so
+    the sample is spread evenly over the image.  Blocks larger than maxpixels
+    are cut into fewer rows.  The sample is the same for the same seed.
+    
+    Returns a list of (xstart, ystart, numberofcolumns, numberofrows) tuples."""
+
+    blockx, blocky = blocksize
+    blockx = min(blockx, xsize)
+    blocky = min(blocky, ysize)
+    if maxpixels != None:
+        blockx = min(blockx, maxpixels)
+        blocky = max(min(blocky, maxpixels // blockx), 1)
+    blocks = plan_segments(xsize, ysize, (blockx, blocky), 1, 1)
+
+    count = min(max(int(numpy.ceil(len(blocks) * fraction)), 1), len(blocks))
+    random = numpy.random.RandomState(seed)
+    edges = numpy.linspace(0, len(blocks), count + 1)
+    output = []
+    for k in xrange(count):
+        index = int(edges[k] + random.random_sample() * (edges[k+1] - edges[k]))
+        output.append(blocks[min(index, len(blocks) - 1)])
+    return output
+
+
+def align_segments(segments, xsize, ysize, multiple):
+    """Function to move the edges of a grid of segments back to multiples of 
+    multiple, e.g. so that each segment covers whole pixels of every overview.
+    Segments which become empty are dropped.
+    
+    Returns a list of (xstart, ystart, numberofcolumns, numberofrows) tuples."""
+
+    xstarts = sorted(set([(x // multiple) * multiple for (x, y, columns, rows) in segments]))
+    ystarts = sorted(set([(y // multiple) * multiple for (x, y, columns, rows) in segments]))
+    xstops = xstarts[1:] + [xsize]
+    ystops = ystarts[1:] + [ysize]
+
+    output = []
+    for y, ystop in zip(ystarts, ystops):
+        for x, xstop in zip(xstarts, xstops):
+            output.append((x, y, xstop - x, ystop - y))
+    return output
+
+
+def add_halo(chunk, halo, xsize, ysize):
+    """Function to expand a segment by halo pixels on every side, clipped to 
+    the image, so that neighbourhood filters see the pixels beyond the edges
+    of the segment.  The segment is cropped back out of the result with 
+    crop_halo.
+    
+    Returns the (xstart, ystart, numberofcolumns, numberofrows) to be read."""
+
+    (xstart, ystart, intervalx, intervaly) = chunk
+    readx = max(xstart - halo, 0)
+    ready = max(ystart - halo, 0)
+    readcolumns = min(xstart + intervalx + halo, xsize) - readx
+    readrows = min(ystart + intervaly + halo, ysize) - ready
+    return (readx, ready, readcolumns, readrows)
+
+
+def crop_halo(array, chunk, halo, xsize, ysize):
+    """Function to return the view of an array, read with add_halo, which 
+    covers only the segment."""
 
+    (xstart, ystart, intervalx, intervaly) = chunk
+    (readx, ready, readcolumns, readrows) = add_halo(chunk, halo, xsize, ysize)
+    xoffset = xstart - readx
+    yoffset = ystart - ready
+    return array[yoffset:yoffset + intervaly, xoffset:xoffset + intervalx]
@@ -4,7 +4,6 @@ import scipy.stats
 def gamma_stretch(shared_array, i, args):
     gammavalue = args.gammavalue
     bandmax = args.bandmax
-    print(bandmax, gammavalue)
     arr = shared_array.asarray()
     arr[i] **= (1.0/gammavalue)
     arr[i] *= bandmax
@@ -19,12 +18,56 @@ def histequ_stretch(shared_array, i, args):
     #reshape
     arr[i] = arr[i].reshape(shape)
 
+def _neighbours(position, count):
+    '''
+    The tiles either side of positions in tile units, from the centre of the
+    first tile, and the weight of the second.  Beyond the outer tile centres 
+    both are the outer tile.
+    '''
+    lower = numpy.floor(position)
+    weight = position - lower
+    lower = lower.astype(numpy.intp)
+    upper = numpy.clip(lower + 1, 0, count - 1)
+    numpy.clip(lower, 0, count - 1, out=lower)
+    return lower, upper, weight
+
+def clahe_stretch(shared_array, i, args):
+    '''
+    Contrast limited adaptive histogram equalization.  Each pixel is mapped
+    by the clipped cumulative histograms of the four tiles around it, 
+    args.tile_cdfs from Stats.get_tile_cdfs, blended bilinearly by its 
+    distance to their centres.  The histograms are over args.tile_range, in
+    the units the stretch sees, see Steps.set_band_stats.  The tiles are on a grid over the whole band
+    and args.origin is the (x, y) of the shared array in the band, so the
+    result does not depend on the segmentation.
+    '''
+    cdfs = args.tile_cdfs
+    tiley, tilex, tilesdown, tilesacross = args.tile_grid
+    bins = cdfs.shape[-1]
+    low, high = args.tile_range
+    if high <= low:
+        high = low + 1
+
+    arr = shared_array.asarray()
+    start, stop, step = i.indices(arr.shape[0])
+    originx, originy = args.origin
+    y0, y1, wy = _neighbours((originy + numpy.arange(start, stop) + 0.5) / tiley - 0.5, tilesdown)
+    x0, x1, wx = _neighbours((originx + numpy.arange(arr.shape[1]) + 0.5) / tilex - 0.5, tilesacross)
+    y0, y1, wy = y0[:, None], y1[:, None], wy[:, None]
+
+    level = (arr[i] - low) * (bins / float(high - low))
+    level[numpy.isnan(level)] = 0
+    level = numpy.clip(level, 0, bins - 1).astype(numpy.intp)
+    top = cdfs[y0, x0, level] * (1 - wx) + cdfs[y0, x1, level] * wx
+    bottom = cdfs[y1, x0, level] * (1 - wx) + cdfs[y1, x1, level] * wx
+    arr[i] = low + (top * (1 - wy) + bottom * wy) * (high - low)
+
 def logarithmic_stretch(shared_array, i, args):
     maximum = args.maximum
     epsilon = args.epsilon
     #Find the scaling constant
     c = 255/(numpy.log10(1+abs(maximum)))
-    arr = shared_arr.asarray()
+    arr = shared_array.asarray()
     arr[i] = c * numpy.log10(epsilon + abs(arr[i]))
     
 def fft_pass(shared_array, i, args):
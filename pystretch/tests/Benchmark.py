@@ -0,0 +1,238 @@
+"""
+Benchmark times pystretcher.py on synthetic rasters, so that releases can be
+compared without a real image.
+
+Rasters are generated in a temporary directory as GeoTIFFs of a given size,
+type, band count and layout, with a fraction of no data pixels.  Every stretch
+and filter is then run over every raster, backend, segment size and number of
+workers.  Each run is a separate process, so that its peak resident set size
+(RSS) is its own, and writes its stage times with --timings.
+
+The report is a JSON file with the machine and library versions and one
+result per case: the wall time, the throughput in millions of pixels per
+second, the peak RSS and the time of each stage.  Cases are named so that two
+reports can be matched up, see compare.
+"""
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+from osgeo import gdal
+
+from pystretch.core import GdalIO, OptParse, Stats
+
+#The range of the synthetic values of each type, the no data value is outside it
+_value_ranges = {'Byte' : (0, 250),
+                 'UInt16' : (0, 4095),
+                 'Int16' : (-2048, 2047),
+                 'UInt32' : (0, 1000000),
+                 'Int32' : (-500000, 500000),
+                 'Float32' : (-1.0, 1.0),
+                 'Float64' : (-1.0, 1.0)}
+
+#Placeholders with no stretch of their own are not timed
+_skip = ['custom_stretch']
+
+#Options of the stretches which need them, as a --step spec
+_settings = {'linear_stretch' : 'clip=2'}
+
+
+def raster_name(xsize, ysize, bands, dtype, tiled, nodata):
+    '''The name of a synthetic raster, which is also its file name.'''
+    layout = 'tiled' if tiled else 'striped'
+    return '%s-%ix%ix%i-%s-nd%g' %(dtype, xsize, ysize, bands, layout, nodata)
+
+
+def make_raster(filename, xsize, ysize, bands=1, dtype='UInt16', tiled=False, blocksize=256, nodata=0.0, seed=0):
+    '''
+    Write a synthetic GeoTIFF.  Each band is a diagonal gradient with noise
+    over the range of the type in _value_ranges, so every stretch has a
+    histogram to work on.  A fraction nodata of the pixels, at random, are the
+    no data value of the type, see GdalIO.DefaultNDVLookup.  The raster is
+    written a block row at a time.
+    '''
+    options = []
+    if tiled:
+        options = ['TILED=YES', 'BLOCKXSIZE=%i' %blocksize, 'BLOCKYSIZE=%i' %blocksize]
+    driver = gdal.GetDriverByName('GTiff')
+    raster = driver.Create(filename, xsize, ysize, bands, gdal.GetDataTypeByName(dtype), options)
+    raster.SetGeoTransform((0, 1, 0, 0, 0, -1))
+    low, high = _value_ranges[dtype]
+    ndv = GdalIO.DefaultNDVLookup[dtype]
+    random = numpy.random.RandomState(seed)
+    rows = blocksize
+    for b in xrange(bands):
+        band = raster.GetRasterBand(b + 1)
+        if nodata > 0:
+            band.SetNoDataValue(ndv)
+        x = numpy.arange(xsize, dtype=numpy.float64) / max(xsize - 1, 1)
+        for ystart in xrange(0, ysize, rows):
+            count = min(rows, ysize - ystart)
+            y = numpy.arange(ystart, ystart + count, dtype=numpy.float64)[:, None] / max(ysize - 1, 1)
+            values = (x + y) / 2.0 * 0.8 + random.rand(count, xsize) * 0.2
+            values = low + values * (high - low)
+            values[random.rand(count, xsize) < nodata] = ndv
+            band.WriteArray(values.astype(Stats.datatype(dtype)), 0, ystart)
+    raster = None
+
+
+def cases(rasters, stretches, backends, budgets, cores):
+    '''
+    Every combination of raster, stretch, backend, memory budget and number
+    of workers, as a list of dictionaries.
+    '''
+    return [{'raster' : raster,
+             'stretch' : stretch,
+             'backend' : backend,
+             'budget' : budget,
+             'cores' : processes}
+            for raster, stretch, backend, budget, processes in itertools.product(rasters, stretches, backends, budgets, cores)]
+
+
+def case_name(case):
+    '''The name of a case, the same in every report.'''
+    return '%s/%s/%s/%s/%i' %(case['raster'], case['stretch'], case['backend'], case['budget'] or 'whole', case['cores'])
+
+
+def run_case(script, case, directory):
+    '''
+    Run one case of pystretcher.py in its own process.
+
+    Returns a result dictionary with the case, the status and, if the run
+    succeeded, seconds, mpx_per_s, peak_rss_mb, the stage times and the
+    time the workers spent in each task.
+    '''
+    inputname = os.path.join(directory, case['raster'] + '.tif')
+    outputname = os.path.join(directory, 'output.tif')
+    timings = os.path.join(directory, 'timings.json')
+    step = case['stretch']
+    if step in _settings:
+        step += ':' + _settings[step]
+    command = [sys.executable, script, inputname, '-o', outputname,
+               '--step', step,
+               '--backend', case['backend'],
+               '--processes', str(case['cores']),
+               '--timings', timings]
+    if case['budget'] != None:
+        command += ['--memory-budget', case['budget']]
+    if os.path.exists(timings):
+        os.remove(timings)
+
+    result = dict(case, name=case_name(case))
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(command, stdout=devnull, stderr=subprocess.PIPE)
+        #Read stderr before waiting, so a chatty run can not block on a full pipe
+        errors = process.stderr.read()
+        pid, status, usage = os.wait4(process.pid, 0)
+    if status != 0 or not os.path.exists(timings):
+        result['status'] = 'failed'
+        result['message'] = errors.strip().splitlines()[-1] if errors.strip() else 'exit status %i' %status
+        return result
+
+    with open(timings) as f:
+        timed = json.load(f)
+    #ru_maxrss is in kilobytes on Linux and bytes on OS X, it is the largest single process
+    rss = usage.ru_maxrss / 1024.0
+    if sys.platform == 'darwin':
+        rss /= 1024.0
+    result['status'] = 'ok'
+    result['seconds'] = timed['total']
+    result['mpx_per_s'] = timed['pixels'] / 1e6 / timed['total']
+    result['peak_rss_mb'] = rss
+    result['stages'] = timed['stages']
+    result['tasks'] = timed['tasks']
+    return result
+
+
+def best(results):
+    '''The fastest of repeated results of a case, or the last if every one failed.'''
+    ok = [result for result in results if result['status'] == 'ok']
+    if not ok:
+        return results[-1]
+    return min(ok, key=lambda result: result['seconds'])
+
+
+def environment():
+    '''The machine and the versions the benchmark was run with.'''
+    return {'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'machine' : platform.platform(),
+            'processor' : platform.processor(),
+            'cpus' : multiprocessing.cpu_count(),
+            'python' : platform.python_version(),
+            'numpy' : numpy.__version__,
+            'gdal' : gdal.VersionInfo('RELEASE_NAME')}
+
+
+def run(script, rasters, stretches=None, backends=('processes', 'threads'), budgets=(None,), cores=(1,), repeat=1, directory=None, keep=False):
+    '''
+    Generate the rasters and time every case.
+
+    rasters is a list of dictionaries with the arguments of make_raster, other
+    than the file name.  stretches defaults to every stretch and filter in
+    OptParse.stretches.  budgets are --memory-budget sizes, e.g. 64M, None
+    for a single segment.  Each case is run repeat times and the fastest run
+    is kept.  The rasters are written to directory, a temporary directory by
+    default, which is removed unless keep.
+
+    Returns the report as a dictionary.
+    '''
+    if stretches is None:
+        stretches = sorted([name for name in OptParse.stretches if name not in _skip])
+    temporary = directory is None
+    if temporary:
+        directory = tempfile.mkdtemp(prefix='pystretch_bench_')
+    elif not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    results = []
+    try:
+        names = []
+        for settings in rasters:
+            name = raster_name(settings['xsize'], settings['ysize'], settings.get('bands', 1), settings.get('dtype', 'UInt16'), settings.get('tiled', False), settings.get('nodata', 0.0))
+            print "Generating %s" %name
+            make_raster(os.path.join(directory, name + '.tif'), **settings)
+            names.append(name)
+
+        todo = cases(names, stretches, backends, budgets, cores)
+        for count, case in enumerate(todo):
+            result = best([run_case(script, case, directory) for r in xrange(repeat)])
+            if result['status'] == 'ok':
+                print "%i of %i %s: %.3f s, %.2f Mpx/s, %.0f MB" %(count + 1, len(todo), result['name'], result['seconds'], result['mpx_per_s'], result['peak_rss_mb'])
+            else:
+                print "%i of %i %s: failed, %s" %(count + 1, len(todo), result['name'], result['message'])
+            results.append(result)
+    finally:
+        if temporary and not keep:
+            shutil.rmtree(directory, ignore_errors=True)
+        elif keep:
+            print "The rasters are kept in %s" %directory
+
+    return {'environment' : environment(), 'results' : results}
+
+
+def write_report(report, filename):
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def compare(old, new):
+    '''
+    Compare two reports, e.g. of two releases.  Returns a list of (name, old
+    Mpx/s, new Mpx/s, speedup) for the cases which succeeded in both.
+    '''
+    before = dict((result['name'], result) for result in old['results'] if result['status'] == 'ok')
+    rows = []
+    for result in new['results']:
+        if result['status'] != 'ok' or result['name'] not in before:
+            continue
+        previous = before[result['name']]['mpx_per_s']
+        rows.append((result['name'], previous, result['mpx_per_s'], result['mpx_per_s'] / previous))
+    return rows
@@ -0,0 +1,37 @@
+import ctypes
+import unittest
+
+import numpy
+
+from pystretch.core import ArrayConvert
+
+
+class SharedMemBufferTest(unittest.TestCase):
+
+    dtypes = [numpy.int8, numpy.uint8, numpy.int16, numpy.uint16,
+              numpy.int32, numpy.uint32, numpy.float32, numpy.float64]
+
+    def test_native_size(self):
+        #The buffers hold the native types to save memory, so each element takes only its itemsize
+        size = 100
+        for dtype in self.dtypes:
+            dtype = numpy.dtype(dtype)
+            buf = ArrayConvert.SharedMemBuffer(size, dtype=dtype, scratch=True)
+            self.assertEqual(ctypes.sizeof(buf.data), size * dtype.itemsize, dtype)
+            self.assertEqual(ctypes.sizeof(buf.scratch), size * dtype.itemsize, dtype)
+            self.assertEqual(buf.asarray().dtype, dtype)
+            self.assertEqual(buf.asarray().size, size)
+
+    def test_round_trip(self):
+        for dtype in self.dtypes:
+            info = numpy.iinfo(dtype) if numpy.dtype(dtype).kind in 'iu' else numpy.finfo(dtype)
+            array = numpy.array([[info.min, 0], [1, info.max]], dtype=dtype)
+            buf = ArrayConvert.SharedMemBuffer(10, dtype=dtype)
+            buf.load(array)
+            self.assertTrue((buf.asarray() == array).all(), dtype)
+            shared = ArrayConvert.SharedMemArray(array)
+            self.assertTrue((shared.asarray() == array).all(), dtype)
+
+
+if __name__ == '__main__':
+    unittest.main()
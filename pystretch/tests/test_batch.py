@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pystretch.core import Batch
+
+
+class ExpandInputsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name in ['a.tif', 'b.tif', 'a_stretched.tif', 'a_stretched_stretched.tif', 'c8.tif']:
+            open(os.path.join(self.directory, name), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def names(self, inputs):
+        return [os.path.basename(path) for path, settings in inputs]
+
+    def test_glob_skips_template_outputs(self):
+        #The outputs of earlier runs are matched by the glob too
+        spec = os.path.join(self.directory, '*.tif')
+        inputs = Batch.expand_inputs(spec, '{dir}/{name}_stretched.tif')
+        self.assertEqual(self.names(inputs), ['a.tif', 'b.tif', 'c8.tif'])
+
+    def test_glob_skips_reported_outputs(self):
+        spec = os.path.join(self.directory, '*.tif')
+        outputs = [os.path.join(self.directory, 'c8.tif')]
+        inputs = Batch.expand_inputs(spec, '{dir}/{name}_stretched.tif', outputs)
+        self.assertEqual(self.names(inputs), ['a.tif', 'b.tif'])
+
+    def test_output_in_place(self):
+        #A template naming the input itself does not drop every input
+        spec = os.path.join(self.directory, '?.tif')
+        self.assertEqual(self.names(Batch.expand_inputs(spec, '{dir}/{name}{ext}')), ['a.tif', 'b.tif'])
+
+    def test_list_used_as_given(self):
+        listing = os.path.join(self.directory, 'list.txt')
+        with open(listing, 'w') as f:
+            f.write('a.tif\n#b.tif\na_stretched.tif\n')
+        inputs = Batch.expand_inputs('@' + listing, '{dir}/{name}_stretched.tif')
+        self.assertEqual(self.names(inputs), ['a.tif', 'a_stretched.tif'])
+
+
+if __name__ == '__main__':
+    unittest.main()
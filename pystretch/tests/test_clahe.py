@@ -0,0 +1,66 @@
+import argparse
+import unittest
+
+import numpy
+
+from pystretch.core import Stats, Stretcher, WorkerPool
+from pystretch.masks import Segment
+from pystretch.nonlinear import Nonlinear
+
+
+class ClaheTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        yy, xx = numpy.mgrid[0:61, 0:47]
+        self.array = (xx + 2 * yy + rng.gamma(2.0, 10.0, (61, 47))).astype(numpy.float32)
+
+    def segmented(self, pool, segments, tiles=4, clip_limit=2.0, num_bins=64):
+        '''CLAHE of the array one segment at a time, as pystretcher runs it.'''
+        low, high = float(self.array.min()), float(self.array.max())
+        rows, columns = self.array.shape
+        args = argparse.Namespace(tile_grid=Stats.tile_grid(columns, rows, tiles), num_bins=num_bins,
+                                  bandmin=low, bandmax=high, tile_range=(low, high))
+        shared_array = pool.buffers[0]
+        hist = 0
+        for chunk in segments:
+            (xstart, ystart, intervalx, intervaly) = chunk
+            shared_array.load(self.array[ystart:ystart + intervaly, xstart:xstart + intervalx])
+            hist = hist + Stats.tile_histograms(pool, 0, chunk, chunk, False, args)
+        args.tile_cdfs = Stats.tile_cdfs(hist, clip_limit)
+
+        result = numpy.empty_like(self.array)
+        for chunk in segments:
+            (xstart, ystart, intervalx, intervaly) = chunk
+            shared_array.load(self.array[ystart:ystart + intervaly, xstart:xstart + intervalx])
+            args.origin = (xstart, ystart)
+            pool.map(Nonlinear.clahe_stretch, 0, args)
+            result[ystart:ystart + intervaly, xstart:xstart + intervalx] = shared_array.asarray()
+        return result
+
+    def test_segments_match_whole(self):
+        rows, columns = self.array.shape
+        pool = WorkerPool.ThreadPool(self.array.size, processes=3)
+        try:
+            whole = self.segmented(pool, [(0, 0, columns, rows)])
+            for segments in [Segment.segment_image(columns, rows, 1, 4),
+                             Segment.segment_image(columns, rows, 3, 5),
+                             Segment.plan_segments(columns, rows, (16, 16), 900, 1)]:
+                result = self.segmented(pool, segments)
+                self.assertTrue(numpy.allclose(result, whole, rtol=0, atol=1e-4), segments)
+        finally:
+            pool.close()
+
+    def test_one_tile_is_histogram_equalization(self):
+        #A single tile without a clip limit maps every pixel by the global cumulative histogram
+        low, high = self.array.min(), self.array.max()
+        hist, edges = numpy.histogram(self.array, 64, (low, high))
+        cdf = hist.cumsum() / float(hist.sum())
+        expected = low + cdf[numpy.digitize(self.array, edges[1:-1])] * (high - low)
+        for backend in ['processes', 'threads']:
+            result = Stretcher.stretch(self.array, 'clahe', tiles=1, clip_limit=0, num_bins=64, backend=backend)
+            self.assertTrue(numpy.allclose(result, expected, rtol=0, atol=1e-3), backend)
+
+
+if __name__ == '__main__':
+    unittest.main()
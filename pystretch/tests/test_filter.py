@@ -0,0 +1,30 @@
+import unittest
+
+import numpy
+from scipy import ndimage
+
+from pystretch.core import Stretcher
+from pystretch.filter.Filter import _histogram_median
+
+
+class HistogramMedianTest(unittest.TestCase):
+
+    def test_matches_ndimage(self):
+        rng = numpy.random.RandomState(0)
+        for levels, size in [(2, 3), (8, 5), (32, 7), (256, 21), (256, 4)]:
+            arr = rng.randint(0, levels, (37, 41)).astype(numpy.float32)
+            expected = ndimage.median_filter(arr, size)
+            self.assertTrue((_histogram_median(arr, size, levels) == expected).all(), (levels, size))
+
+    def test_integer_path(self):
+        #Byte data and a 21x21 kernel is filtered by _histogram_median
+        rng = numpy.random.RandomState(1)
+        tile = rng.randint(10, 200, (64, 48)).astype(numpy.uint8)
+        expected = ndimage.median_filter(tile.astype(numpy.float32), 21)
+        for backend in ['processes', 'threads']:
+            result = Stretcher.stretch(tile, 'median_filter', kernel_size=21, backend=backend)
+            self.assertTrue((result == expected).all(), backend)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import argparse
+import unittest
+
+import numpy
+
+from pystretch.core import ArrayConvert, NoData
+
+
+class NoDataMaskTest(unittest.TestCase):
+    '''Masks of rasters whose rows do not fill whole bytes.'''
+
+    buffers = [ArrayConvert.SharedMemBuffer, ArrayConvert.ArrayBuffer]
+
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        #37 rows do not divide into the slices of 4 workers, 13 columns are not whole bytes
+        self.array = rng.randint(0, 4, (37, 13)).astype(numpy.float32)
+        self.array[5, 3] = numpy.nan
+        self.expected = (self.array != 0) & ~numpy.isnan(self.array)
+        self.pool = argparse.Namespace(processes=4)
+        self.args = argparse.Namespace(ndv=0, fill=False)
+
+    def marked(self, buffer_type):
+        shared_array = buffer_type(self.array.size + 100)
+        shared_array.load(self.array)
+        invalid = 0
+        for i in NoData.slices(self.pool, self.array.shape[0]):
+            invalid += NoData.mark(shared_array, i, self.args)
+        self.assertEqual(invalid, self.expected.size - self.expected.sum())
+        return shared_array
+
+    def test_slices_cover_rows(self):
+        rows = self.array.shape[0]
+        slices = NoData.slices(self.pool, rows)
+        for i in slices:
+            self.assertEqual(i.start % 8, 0)
+        self.assertEqual(sum([len(xrange(*i.indices(rows))) for i in slices]), rows)
+
+    def test_valid_unaligned_rows(self):
+        for buffer_type in self.buffers:
+            shared_array = self.marked(buffer_type)
+            for start, stop in [(0, 37), (3, 11), (5, 6), (13, 37), (29, 40), (36, 37), (9, 9)]:
+                result = NoData.valid(shared_array, slice(start, stop))
+                self.assertTrue((result == self.expected[start:stop]).all(), (buffer_type.__name__, start, stop))
+            self.assertTrue((NoData.valid(shared_array, slice(None)) == self.expected).all())
+
+    def test_fill(self):
+        self.args.fill = True
+        for buffer_type in self.buffers:
+            shared_array = self.marked(buffer_type)
+            self.assertTrue(numpy.isnan(shared_array.asarray()[~self.expected]).all())
+            self.assertTrue(numpy.isfinite(shared_array.asarray()[self.expected]).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
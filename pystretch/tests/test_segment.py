@@ -0,0 +1,51 @@
+import unittest
+
+import numpy
+
+from pystretch.masks import Segment
+
+
+def coverage(xsize, ysize, segments):
+    '''The number of segments covering each pixel.'''
+    counts = numpy.zeros((ysize, xsize), dtype=numpy.int32)
+    for (xstart, ystart, intervalx, intervaly) in segments:
+        counts[ystart:ystart + intervaly, xstart:xstart + intervalx] += 1
+    return counts
+
+
+class SegmentImageTest(unittest.TestCase):
+
+    def test_every_pixel_once(self):
+        #Sizes which do not divide evenly used to append an overlapping remainder segment
+        for xsize, ysize, xsegment, ysegment in [(257, 300, 3, 1), (257, 300, 3, 7), (100, 100, 1, 1),
+                                                 (9, 9, 3, 3), (10, 7, 4, 2), (64, 64, 8, 8)]:
+            segments = Segment.segment_image(xsize, ysize, xsegment, ysegment)
+            counts = coverage(xsize, ysize, segments)
+            self.assertTrue((counts == 1).all(), (xsize, ysize, xsegment, ysegment))
+
+    def test_remainder_joins_last_segment(self):
+        self.assertEqual(Segment.segment_image(257, 300, 3, 1),
+                         [(0, 0, 85, 300), (85, 0, 85, 300), (170, 0, 87, 300)])
+
+
+class PlanSegmentsTest(unittest.TestCase):
+
+    def test_windows_fit_budget(self):
+        #A 10 pixel gaussian filter reads a 40 pixel halo around each segment
+        footprint = Segment.pixel_footprint(1, buffers=3, scratch=True, working=4)
+        for blocksize in [(4000, 1), (4000, 16), (256, 256)]:
+            for halo in [0, 40]:
+                budget = 2 * 1024 * 1024
+                segments = Segment.plan_segments(4000, 2000, blocksize, budget, footprint, halo)
+                windows = [Segment.add_halo(chunk, halo, 4000, 2000) for chunk in segments]
+                largest = max([w[2] * w[3] for w in windows])
+                self.assertTrue(largest * footprint <= budget, (blocksize, halo, largest))
+                counts = coverage(4000, 2000, segments)
+                self.assertTrue((counts == 1).all(), (blocksize, halo))
+
+    def test_single_block_over_budget(self):
+        self.assertEqual(Segment.plan_segments(100, 10, (50, 10), 1, 1, 5), [(0, 0, 50, 10), (50, 0, 50, 10)])
+
+
+if __name__ == '__main__':
+    unittest.main()
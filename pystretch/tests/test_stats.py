@@ -0,0 +1,64 @@
+import unittest
+
+import numpy
+
+from pystretch.core import Stats
+
+
+class RunningStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.values = numpy.concatenate([random.normal(1000, 50, 70000),
+                                         random.exponential(300, 30000)])
+        random.shuffle(self.values)
+
+    def test_merge_uneven_partitions(self):
+        #Partials from workers of uneven slices merge, in any order, to the statistics of the whole
+        bounds = [0, 1, 17, 4096, 4097, 50000, 99990, self.values.size]
+        partials = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            partial = Stats.RunningStats()
+            partial.update(self.values[start:stop])
+            partials.append(partial)
+        for order in (partials, partials[::-1]):
+            total = Stats.RunningStats()
+            for partial in order:
+                total.merge(partial)
+            self.assertEqual(total.count, self.values.size)
+            self.assertAlmostEqual(total.mean, numpy.mean(self.values), places=7)
+            self.assertAlmostEqual(total.std(), numpy.std(self.values), places=7)
+            self.assertEqual(total.minimum, self.values.min())
+            self.assertEqual(total.maximum, self.values.max())
+
+    def test_skips_invalid(self):
+        values = numpy.array([1.0, numpy.nan, 3.0, numpy.inf, 5.0, 7.0])
+        valid = numpy.array([True, True, True, True, True, False])
+        total = Stats.RunningStats()
+        total.update(values, valid)
+        self.assertEqual(total.count, 3)
+        self.assertAlmostEqual(total.mean, 3.0)
+        self.assertAlmostEqual(total.std(), numpy.std([1.0, 3.0, 5.0]))
+
+    def test_percentiles_within_a_bin(self):
+        lower, upper, bins = self.values.min(), self.values.max(), 4096
+        width = (upper - lower) / float(bins)
+        total = Stats.RunningStats(lower, upper, bins)
+        for part in numpy.array_split(self.values, 7):
+            partial = Stats.RunningStats(lower, upper, bins)
+            partial.update(part)
+            total.merge(partial)
+        for p in (0.5, 2, 25, 50, 75, 98, 99.5):
+            self.assertLessEqual(abs(total.percentile(p) - numpy.percentile(self.values, p)), width, p)
+
+    def test_integer_percentiles_exact_bins(self):
+        #One bin per value, as for 8 and 16-bit bands
+        values = numpy.random.RandomState(1).randint(0, 256, 50000).astype(numpy.uint8)
+        total = Stats.RunningStats(-0.5, 255.5, 256)
+        total.update(values)
+        for p in (2, 50, 98):
+            self.assertLessEqual(abs(total.percentile(p) - numpy.percentile(values, p)), 1.0, p)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+
+import numpy
+
+from pystretch.core import Stretcher
+
+
+class DegenerateTileTest(unittest.TestCase):
+    '''Flat and empty tiles, which a tiling service sees all the time.'''
+
+    backends = ['processes', 'threads']
+    methods = [('linear', {'clip' : 2}),
+               ('linear', {}),
+               ('standard_deviation', {}),
+               ('gamma', {}),
+               ('clahe', {}),
+               (['median_filter', 'linear_stretch'], {'clip' : 2})]
+
+    def test_constant_tile(self):
+        for tile in [numpy.full((32, 32), 200, numpy.uint8), numpy.full((32, 32), 2.5, numpy.float32)]:
+            for backend in self.backends:
+                for method, params in self.methods:
+                    result = Stretcher.stretch(tile, method, backend=backend, **params)
+                    self.assertEqual(result.shape, tile.shape)
+                    self.assertTrue(numpy.isfinite(result).all(), (tile.dtype, backend, method))
+                    #A flat tile stays flat
+                    self.assertEqual(len(numpy.unique(result)), 1, (tile.dtype, backend, method))
+
+    def test_all_nodata_tile(self):
+        for tile, ndv in [(numpy.zeros((32, 32), numpy.uint8), 0), (numpy.full((32, 32), -1, numpy.float32), -1)]:
+            for backend in self.backends:
+                for method, params in self.methods:
+                    result = Stretcher.stretch(tile, method, backend=backend, ndv=ndv, **params)
+                    self.assertTrue((result == ndv).all(), (tile.dtype, backend, method))
+
+    def test_all_nan_tile(self):
+        tile = numpy.full((32, 32), numpy.nan, numpy.float32)
+        for backend in self.backends:
+            result = Stretcher.stretch(tile, 'standard_deviation', backend=backend)
+            self.assertTrue(numpy.isnan(result).all())
+
+
+if __name__ == '__main__':
+    unittest.main()